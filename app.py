@@ -1,1207 +1,1570 @@
-import os
-from datetime import datetime, timedelta
-import pytz
-import time
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-import logging
-from backup_service import BackupService
-from models import db, User, Repository, BackupJob, PasswordResetCode
-import atexit
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/app/logs/app.log'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
-
-# Set APScheduler logging level to WARNING to reduce noise
-logging.getLogger('apscheduler').setLevel(logging.WARNING)
-
-# Set timezone
-LOCAL_TZ = pytz.timezone(os.environ.get('TZ', 'UTC'))
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:////app/data/github_backup.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Diagnostic logging for DB path
-db_uri = app.config['SQLALCHEMY_DATABASE_URI']
-logger.info(f"Configured DB URI: {db_uri}")
-if db_uri.startswith('sqlite:///') or db_uri.startswith('sqlite:////'):
-    # Normalize both relative and absolute sqlite URIs
-    normalized = db_uri.replace('sqlite:////', '/').replace('sqlite:///', '')
-    # If we replaced absolute variant, ensure leading slash retained
-    if db_uri.startswith('sqlite:////'):
-        sqlite_file = '/' + normalized.lstrip('/')
-    else:
-        sqlite_file = os.path.abspath(normalized)
-    parent = os.path.dirname(sqlite_file)
-    try:
-        os.makedirs(parent, exist_ok=True)
-        stat_parent = os.stat(parent)
-        logger.info(f"SQLite file target: {sqlite_file} (parent exists, perms {oct(stat_parent.st_mode)[-3:]})")
-    except Exception as e:
-        logger.error(f"Failed ensuring SQLite directory {parent}: {e}")
-
-# Initialize extensions
-db.init_app(app)
-
-# Configure local timezone detection
-def get_local_timezone():
-    """Detect the local system timezone"""
-    # Try environment variable first (Docker/container support)
-    tz_env = os.environ.get('TZ')
-    if tz_env:
-        try:
-            return pytz.timezone(tz_env)
-        except pytz.UnknownTimeZoneError:
-            logger.warning(f"Unknown timezone in TZ environment variable: {tz_env}")
-    
-    # Try system timezone
-    try:
-        # Get system timezone
-        local_tz_name = time.tzname[time.daylight] if time.daylight else time.tzname[0]
-        if local_tz_name:
-            # Try to map common abbreviations to full timezone names
-            tz_mapping = {
-                'CET': 'Europe/Amsterdam',
-                'CEST': 'Europe/Amsterdam', 
-                'EST': 'America/New_York',
-                'EDT': 'America/New_York',
-                'PST': 'America/Los_Angeles',
-                'PDT': 'America/Los_Angeles',
-                'UTC': 'UTC',
-                'GMT': 'UTC'
-            }
-            
-            full_tz_name = tz_mapping.get(local_tz_name, local_tz_name)
-            return pytz.timezone(full_tz_name)
-    except:
-        pass
-    
-    # Fallback to UTC
-    logger.warning("Could not detect local timezone, using UTC")
-    return pytz.UTC
-
-LOCAL_TZ = get_local_timezone()
-logger.info(f"Using timezone: {LOCAL_TZ}")
-
-def to_local_time(utc_dt):
-    """Convert UTC datetime to local time"""
-    if utc_dt is None:
-        return None
-    if utc_dt.tzinfo is None:
-        # Assume UTC if no timezone info
-        utc_dt = pytz.utc.localize(utc_dt)
-    return utc_dt.astimezone(LOCAL_TZ)
-
-# Add Jinja2 filters
-@app.template_filter('local_time')
-def local_time_filter(utc_dt):
-    """Jinja2 filter to convert UTC time to local time"""
-    return to_local_time(utc_dt)
-
-@app.template_filter('format_local_time')
-def format_local_time_filter(utc_dt, format_str='%Y-%m-%d %H:%M'):
-    """Jinja2 filter to format UTC time as local time"""
-    local_dt = to_local_time(utc_dt)
-    if local_dt is None:
-        return "Never"
-    
-    # Get timezone abbreviation
-    tz_name = local_dt.strftime('%Z')
-    if not tz_name:  # Fallback if %Z doesn't work
-        tz_name = str(LOCAL_TZ).split('/')[-1] if '/' in str(LOCAL_TZ) else str(LOCAL_TZ)
-    
-    return f"{local_dt.strftime(format_str)} {tz_name}"
-
-# Immediate connectivity test (runs once at startup)
-from sqlalchemy import text
-with app.app_context():
-    try:
-        db.session.execute(text('SELECT 1'))
-        logger.info('Initial DB connectivity test succeeded.')
-    except Exception as e:
-        logger.error(f'Initial DB connectivity test failed: {e}')
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
-
-# Initialize backup service
-backup_service = BackupService()
-
-# Initialize scheduler with job store to prevent duplicates
-from apscheduler.jobstores.memory import MemoryJobStore
-from apscheduler.executors.pool import ThreadPoolExecutor
-
-jobstores = {
-    'default': MemoryJobStore()
-}
-executors = {
-    'default': ThreadPoolExecutor(max_workers=2)  # Limit concurrent backups
-}
-job_defaults = {
-    'coalesce': True,  # Combine multiple pending executions of the same job
-    'max_instances': 1,  # Only one instance of a job can run at a time
-    'misfire_grace_time': 60  # 1 minute grace time for missed jobs
-}
-
-scheduler = BackgroundScheduler(
-    jobstores=jobstores,
-    executors=executors,
-    job_defaults=job_defaults,
-    timezone=LOCAL_TZ
-)
-scheduler.start()
-atexit.register(lambda: scheduler.shutdown())
-
-def schedule_all_repositories():
-    """Schedule all active repositories on startup"""
-    from datetime import datetime, timedelta  # Import to ensure availability
-    
-    try:
-        # Clean up any stuck 'running' jobs from previous sessions
-        stuck_jobs = BackupJob.query.filter_by(status='running').all()
-        if stuck_jobs:
-            logger.warning(f"Found {len(stuck_jobs)} stuck 'running' jobs from previous session")
-            for stuck_job in stuck_jobs:
-                stuck_job.status = 'failed'
-                stuck_job.error_message = 'Job was running when application restarted'
-                stuck_job.completed_at = datetime.utcnow()
-                logger.info(f"Marked stuck job as failed: {stuck_job.id} for repository {stuck_job.repository_id}")
-            db.session.commit()
-        
-        # Auto-cleanup: Remove duplicate backup jobs created within last hour
-        cutoff = datetime.utcnow() - timedelta(hours=1)
-        recent_jobs = BackupJob.query.filter(BackupJob.created_at > cutoff).all()
-        
-        # Group by repository and find duplicates
-        repo_jobs = {}
-        for job in recent_jobs:
-            repo_id = job.repository_id
-            if repo_id not in repo_jobs:
-                repo_jobs[repo_id] = []
-            repo_jobs[repo_id].append(job)
-        
-        duplicates_cleaned = 0
-        for repo_id, jobs in repo_jobs.items():
-            if len(jobs) > 1:
-                # Sort by creation time, keep the first one, mark others as failed
-                jobs.sort(key=lambda j: j.created_at)
-                for duplicate_job in jobs[1:]:
-                    if duplicate_job.status in ['pending', 'running']:
-                        duplicate_job.status = 'failed'
-                        duplicate_job.error_message = 'Duplicate job automatically cleaned up'
-                        duplicate_job.completed_at = datetime.utcnow()
-                        duplicates_cleaned += 1
-                        logger.info(f"Auto-cleaned duplicate job {duplicate_job.id} for repository {repo_id}")
-        
-        if duplicates_cleaned > 0:
-            db.session.commit()
-            logger.info(f"Auto-cleaned {duplicates_cleaned} duplicate backup jobs")
-
-        # First, clear any existing jobs to prevent duplicates
-        existing_jobs = scheduler.get_jobs()
-        for job in existing_jobs:
-            if job.id.startswith('backup_'):
-                scheduler.remove_job(job.id)
-                logger.info(f"Removed existing job on startup: {job.id}")
-        
-        # Clear our tracking as well
-        with _job_tracking_lock:
-            _scheduled_jobs.clear()
-            logger.info("Cleared job tracking set")
-        
-        repositories = Repository.query.filter_by(is_active=True).all()
-        scheduled_count = 0
-        for repository in repositories:
-            if repository.schedule_type != 'manual':
-                schedule_backup_job(repository)
-                scheduled_count += 1
-                logger.info(f"Scheduled backup job for repository: {repository.name} ({repository.schedule_type})")
-        logger.info(f"Scheduled {scheduled_count} backup jobs on startup")
-        
-        # Schedule a periodic health check job to monitor for duplicates
-        def scheduler_health_check():
-            from datetime import datetime, timedelta
-            with app.app_context():
-                try:
-                    # Check for duplicate jobs in scheduler
-                    all_jobs = scheduler.get_jobs()
-                    backup_jobs = [job for job in all_jobs if job.id.startswith('backup_')]
-                    job_ids = [job.id for job in backup_jobs]
-                    
-                    # Check for duplicate job IDs
-                    if len(job_ids) != len(set(job_ids)):
-                        logger.error("Duplicate scheduler job IDs detected! Cleaning up...")
-                        # Remove all backup jobs and reschedule
-                        for job in backup_jobs:
-                            scheduler.remove_job(job.id)
-                        
-                        # Clear tracking and reschedule
-                        with _job_tracking_lock:
-                            _scheduled_jobs.clear()
-                        
-                        # Reschedule active repositories
-                        repositories = Repository.query.filter_by(is_active=True).all()
-                        for repo in repositories:
-                            if repo.schedule_type != 'manual':
-                                schedule_backup_job(repo)
-                        
-                        logger.info("Scheduler health check: cleaned up and rescheduled jobs")
-                    
-                    # Auto-cleanup old failed jobs (older than 7 days)
-                    old_cutoff = datetime.utcnow() - timedelta(days=7)
-                    old_jobs = BackupJob.query.filter(
-                        BackupJob.status == 'failed',
-                        BackupJob.created_at < old_cutoff
-                    ).all()
-                    
-                    if old_jobs:
-                        for old_job in old_jobs:
-                            db.session.delete(old_job)
-                        db.session.commit()
-                        logger.info(f"Auto-cleaned {len(old_jobs)} old failed backup jobs")
-                        
-                except Exception as e:
-                    logger.error(f"Scheduler health check failed: {e}")
-        
-        # Schedule health check to run every 6 hours
-        scheduler.add_job(
-            func=scheduler_health_check,
-            trigger=CronTrigger(hour='*/6', timezone=LOCAL_TZ),
-            id='scheduler_health_check',
-            name='Scheduler Health Check',
-            replace_existing=True,
-            misfire_grace_time=300,
-            coalesce=True,
-            max_instances=1
-        )
-        logger.info("Scheduled periodic scheduler health check")
-        
-    except Exception as e:
-        logger.error(f"Error scheduling repositories on startup: {e}")
-
-# Thread-safe flag to ensure we only initialize once
-import threading
-_scheduler_lock = threading.Lock()
-_scheduler_initialized = False
-
-# Global tracking of scheduled jobs to prevent duplicates
-_scheduled_jobs = set()
-_job_tracking_lock = threading.Lock()
-
-def ensure_scheduler_initialized():
-    """Ensure scheduler is initialized with existing repositories (thread-safe)"""
-    global _scheduler_initialized
-    if _scheduler_initialized:
-        return
-        
-    with _scheduler_lock:
-        # Double-check pattern to avoid race conditions
-        if not _scheduler_initialized:
-            logger.info("Initializing scheduler with existing repositories...")
-            schedule_all_repositories()
-            _scheduler_initialized = True
-            logger.info("Scheduler initialization completed")
-
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
-
-@app.route('/')
-@login_required
-def dashboard():
-    repositories = Repository.query.filter_by(user_id=current_user.id).all()
-    recent_jobs = BackupJob.query.filter_by(user_id=current_user.id).order_by(BackupJob.created_at.desc()).limit(10).all()
-    return render_template('dashboard.html', repositories=repositories, recent_jobs=recent_jobs)
-
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    # Auto-create default admin if no users
-    if User.query.count() == 0:
-        admin = User(username='admin', password_hash=generate_password_hash('changeme'), is_admin=True, theme='dark')
-        db.session.add(admin)
-        db.session.commit()
-        logger.warning('Default admin user created with username=admin password=changeme; please change immediately.')
-    if request.method == 'POST':
-        username = request.form['username']
-        password = request.form['password']
-        user = User.query.filter_by(username=username).first()
-        
-        if user and check_password_hash(user.password_hash, password):
-            login_user(user)
-            return redirect(url_for('dashboard'))
-        else:
-            flash('Invalid username or password', 'error')
-    
-    return render_template('login.html')
-
-@app.route('/logout')
-@login_required
-def logout():
-    logout_user()
-    return redirect(url_for('login'))
-
-@app.route('/settings', methods=['GET', 'POST'])
-@login_required
-def user_settings():
-    if request.method == 'POST':
-        # Handle theme change
-        theme = request.form.get('theme')
-        if theme in ['dark', 'light']:
-            current_user.theme = theme
-            flash('Appearance settings updated', 'success')
-            db.session.commit()
-            return redirect(url_for('user_settings'))
-        
-        # Handle account changes
-        new_username = request.form.get('username', '').strip()
-        current_password = request.form.get('current_password', '')
-        new_password = request.form.get('new_password', '')
-        confirm_password = request.form.get('confirm_password', '')
-
-        # Change username
-        if new_username and new_username != current_user.username:
-            if User.query.filter_by(username=new_username).first():
-                flash('Username already taken', 'error')
-                return redirect(url_for('user_settings'))
-            current_user.username = new_username
-            flash('Username updated', 'success')
-
-        # Change password
-        if new_password:
-            if not check_password_hash(current_user.password_hash, current_password):
-                flash('Current password incorrect', 'error')
-                return redirect(url_for('user_settings'))
-            if new_password != confirm_password:
-                flash('New passwords do not match', 'error')
-                return redirect(url_for('user_settings'))
-            current_user.password_hash = generate_password_hash(new_password)
-            flash('Password updated', 'success')
-
-        db.session.commit()
-        return redirect(url_for('user_settings'))
-
-    return render_template('settings.html')
-
-import secrets
-
-@app.route('/forgot-password', methods=['GET', 'POST'])
-def forgot_password():
-    if request.method == 'POST':
-        username = request.form.get('username', '').strip()
-        user = User.query.filter_by(username=username).first()
-        if not user:
-            flash('If that user exists, a reset code has been generated (check logs).', 'info')
-            return redirect(url_for('forgot_password'))
-        # Invalidate previous unused codes for this user
-        PasswordResetCode.query.filter_by(user_id=user.id, used=False).delete()
-        code = secrets.token_hex(4)
-        prc = PasswordResetCode(user_id=user.id, code=code)
-        db.session.add(prc)
-        db.session.commit()
-        logger.warning(f'PASSWORD RESET CODE for user={user.username}: {code}')
-        flash('Reset code generated. Check server logs.', 'info')
-        return redirect(url_for('reset_password'))
-    return render_template('forgot_password.html')
-
-@app.route('/reset-password', methods=['GET', 'POST'])
-def reset_password():
-    if request.method == 'POST':
-        username = request.form.get('username', '').strip()
-        code = request.form.get('code', '').strip()
-        new_password = request.form.get('new_password', '')
-        confirm_password = request.form.get('confirm_password', '')
-        user = User.query.filter_by(username=username).first()
-        if not user:
-            flash('Invalid code or user', 'error')
-            return redirect(url_for('reset_password'))
-        prc = PasswordResetCode.query.filter_by(user_id=user.id, code=code, used=False).first()
-        if not prc:
-            flash('Invalid or already used code', 'error')
-            return redirect(url_for('reset_password'))
-        if new_password != confirm_password or not new_password:
-            flash('Passwords do not match or empty', 'error')
-            return redirect(url_for('reset_password'))
-        user.password_hash = generate_password_hash(new_password)
-        prc.used = True
-        db.session.commit()
-        flash('Password reset successful. You can now log in.', 'success')
-        return redirect(url_for('login'))
-    return render_template('reset_password.html')
-
-@app.route('/repositories')
-@login_required
-def repositories():
-    repos = Repository.query.filter_by(user_id=current_user.id).all()
-    
-    # Get backup job status
-    running_jobs = BackupJob.query.filter_by(user_id=current_user.id, status='running').all()
-    pending_jobs = BackupJob.query.filter_by(user_id=current_user.id, status='pending').all()
-    completed_jobs = BackupJob.query.filter_by(user_id=current_user.id, status='completed').all()
-    failed_jobs = BackupJob.query.filter_by(user_id=current_user.id, status='failed').all()
-    
-    # Calculate status
-    total_repos = len(repos)
-    running_count = len(running_jobs)
-    pending_count = len(pending_jobs)
-    
-    # Status percentage (based on active backups vs total)
-    active_backups = running_count + pending_count
-    
-    backup_status = {
-        'running': running_count,
-        'pending': pending_count,
-        'completed': len(completed_jobs),
-        'failed': len(failed_jobs),
-        'total_repos': total_repos,
-        'active': active_backups > 0,
-        'running_jobs': running_jobs,
-        'pending_jobs': pending_jobs
-    }
-    
-    return render_template('repositories.html', repositories=repos, backup_status=backup_status)
-
-@app.route('/repositories/add', methods=['GET', 'POST'])
-@login_required
-def add_repository():
-    if request.method == 'POST':
-        repo_url = request.form['repo_url']
-        github_token = request.form.get('github_token', '')
-        backup_format = request.form['backup_format']
-        schedule_type = request.form['schedule_type']
-        retention_count = int(request.form['retention_count'])
-        
-        # Handle custom schedule fields
-        custom_interval = None
-        custom_unit = None
-        custom_hour = 2
-        custom_minute = 0
-        
-        if schedule_type == 'custom':
-            custom_interval = int(request.form.get('custom_interval', 1))
-            custom_unit = request.form.get('custom_unit', 'days')
-            custom_time = request.form.get('custom_time', '02:00')
-            
-            # Validate custom schedule parameters
-            if custom_unit == 'days' and (custom_interval < 1 or custom_interval > 365):
-                flash('Custom interval for days must be between 1 and 365', 'error')
-                return render_template('add_repository.html')
-            elif custom_unit == 'weeks' and (custom_interval < 1 or custom_interval > 52):
-                flash('Custom interval for weeks must be between 1 and 52', 'error')
-                return render_template('add_repository.html')
-            elif custom_unit == 'months' and (custom_interval < 1 or custom_interval > 12):
-                flash('Custom interval for months must be between 1 and 12', 'error')
-                return render_template('add_repository.html')
-            
-            try:
-                time_parts = custom_time.split(':')
-                custom_hour = int(time_parts[0])
-                custom_minute = int(time_parts[1])
-                
-                if custom_hour < 0 or custom_hour > 23:
-                    flash('Hour must be between 0 and 23', 'error')
-                    return render_template('add_repository.html')
-                if custom_minute < 0 or custom_minute > 59:
-                    flash('Minute must be between 0 and 59', 'error')
-                    return render_template('add_repository.html')
-                    
-            except (IndexError, ValueError):
-                flash('Invalid time format. Please use HH:MM format', 'error')
-                return render_template('add_repository.html')
-        
-        # Extract repo name from URL
-        repo_name = repo_url.split('/')[-1].replace('.git', '')
-        
-        repository = Repository(
-            user_id=current_user.id,
-            name=repo_name,
-            url=repo_url,
-            github_token=github_token,
-            backup_format=backup_format,
-            schedule_type=schedule_type,
-            retention_count=retention_count,
-            custom_interval=custom_interval,
-            custom_unit=custom_unit,
-            custom_hour=custom_hour,
-            custom_minute=custom_minute,
-            is_active=True
-        )
-        
-        db.session.add(repository)
-        db.session.commit()
-        
-        # Schedule the backup job
-        schedule_backup_job(repository)
-        
-        flash('Repository added successfully', 'success')
-        return redirect(url_for('repositories'))
-    
-    return render_template('add_repository.html')
-
-@app.route('/repositories/add-by-username', methods=['GET', 'POST'])
-@login_required
-def add_repositories_by_username():
-    """Add all repositories from a GitHub user"""
-    if request.method == 'POST':
-        github_username = request.form.get('github_username', '').strip()
-        github_token = request.form.get('github_token', '').strip()
-        backup_format = request.form.get('backup_format', 'folder')
-        schedule_type = request.form.get('schedule_type', 'daily')
-        retention_count = int(request.form.get('retention_count', 5))
-        
-        if not github_username:
-            flash('Please provide a GitHub username', 'error')
-            return render_template('add_by_username.html')
-        
-        try:
-            from github import Github, GithubException
-            
-            # Initialize GitHub API
-            if github_token:
-                g = Github(github_token)
-            else:
-                g = Github()  # Unauthenticated (limited rate limit)
-            
-            # Fetch the user
-            try:
-                user = g.get_user(github_username)
-            except GithubException as e:
-                flash(f'GitHub user "{github_username}" not found or API error: {str(e)}', 'error')
-                logger.warning(f"Failed to fetch GitHub user {github_username}: {str(e)}")
-                return render_template('add_by_username.html')
-            
-            # Get all repositories
-            try:
-                repos = user.get_repos(type='all')  # all, public, private
-                repos_list = list(repos)
-            except GithubException as e:
-                flash(f'Error fetching repositories: {str(e)}', 'error')
-                logger.warning(f"Failed to fetch repos for {github_username}: {str(e)}")
-                return render_template('add_by_username.html')
-            
-            if not repos_list:
-                flash(f'No repositories found for user "{github_username}"', 'info')
-                return redirect(url_for('repositories'))
-            
-            added_count = 0
-            skipped_count = 0
-            failed_repos = []
-            
-            for repo in repos_list:
-                try:
-                    # Skip if repo is a fork (optional - change if you want to include forks)
-                    if repo.fork:
-                        logger.info(f"Skipping forked repository: {repo.name}")
-                        skipped_count += 1
-                        continue
-                    
-                    repo_name = repo.name
-                    repo_url = repo.clone_url  # Uses HTTPS URL
-                    
-                    # Check if this repository already exists for this user
-                    existing = Repository.query.filter_by(
-                        user_id=current_user.id,
-                        name=repo_name,
-                        url=repo_url
-                    ).first()
-                    
-                    if existing:
-                        logger.info(f"Repository {repo_name} already exists for user, skipping")
-                        skipped_count += 1
-                        continue
-                    
-                    # Create new repository record
-                    new_repo = Repository(
-                        user_id=current_user.id,
-                        name=repo_name,
-                        url=repo_url,
-                        github_token=github_token if repo.private else '',  # Only store token for private repos
-                        backup_format=backup_format,
-                        schedule_type=schedule_type,
-                        retention_count=retention_count,
-                        is_active=True
-                    )
-                    
-                    db.session.add(new_repo)
-                    added_count += 1
-                    logger.info(f"Added repository: {repo_name}")
-                    
-                except Exception as e:
-                    failed_repos.append((repo.name, str(e)))
-                    logger.error(f"Failed to add repository {repo.name}: {str(e)}")
-                    continue
-            
-            # Commit all new repositories
-            if added_count > 0:
-                try:
-                    db.session.commit()
-                    logger.info(f"Committed {added_count} new repositories for user {current_user.id}")
-                    
-                    # Now schedule backup jobs for newly added repositories
-                    new_repos = Repository.query.filter_by(
-                        user_id=current_user.id,
-                        name=repo_name  # This will get the last one, but we'll schedule all active ones
-                    ).filter(Repository.schedule_type != 'manual').all()
-                    
-                    # Actually, let's schedule all added repos from this batch
-                    # Get repos added in last few seconds
-                    cutoff_time = datetime.utcnow() - timedelta(seconds=5)
-                    recently_added = Repository.query.filter_by(
-                        user_id=current_user.id,
-                        is_active=True
-                    ).filter(Repository.created_at > cutoff_time).all()
-                    
-                    for repo in recently_added:
-                        if repo.schedule_type != 'manual':
-                            try:
-                                schedule_backup_job(repo)
-                                logger.info(f"Scheduled backup for {repo.name}")
-                            except Exception as e:
-                                logger.error(f"Failed to schedule backup for {repo.name}: {e}")
-                    
-                except Exception as e:
-                    db.session.rollback()
-                    flash(f'Error saving repositories: {str(e)}', 'error')
-                    logger.error(f"Failed to commit repositories: {str(e)}")
-                    return render_template('add_by_username.html')
-            
-            # Build success message
-            message = f'Successfully added {added_count} repositories'
-            if skipped_count > 0:
-                message += f' ({skipped_count} skipped - already exist or are forks)'
-            if failed_repos:
-                message += f' ({len(failed_repos)} failed)'
-            
-            flash(message, 'success')
-            
-            if failed_repos:
-                logger.warning(f"Failed to add {len(failed_repos)} repositories: {failed_repos}")
-            
-            return redirect(url_for('repositories'))
-            
-        except Exception as e:
-            flash(f'Unexpected error: {str(e)}', 'error')
-            logger.error(f"Unexpected error in add_repositories_by_username: {str(e)}", exc_info=True)
-            return render_template('add_by_username.html')
-    
-    return render_template('add_by_username.html')
-
-@app.route('/repositories/<int:repo_id>/edit', methods=['GET', 'POST'])
-@login_required
-def edit_repository(repo_id):
-    repository = Repository.query.filter_by(id=repo_id, user_id=current_user.id).first_or_404()
-    
-    if request.method == 'POST':
-        repository.github_token = request.form.get('github_token', '')
-        repository.backup_format = request.form['backup_format']
-        repository.schedule_type = request.form['schedule_type']
-        repository.retention_count = int(request.form['retention_count'])
-        repository.is_active = 'is_active' in request.form
-        
-        # Handle custom schedule fields
-        if repository.schedule_type == 'custom':
-            custom_interval = int(request.form.get('custom_interval', 1))
-            custom_unit = request.form.get('custom_unit', 'days')
-            custom_time = request.form.get('custom_time', '02:00')
-            
-            # Validate custom schedule parameters
-            if custom_unit == 'days' and (custom_interval < 1 or custom_interval > 365):
-                flash('Custom interval for days must be between 1 and 365', 'error')
-                return render_template('edit_repository.html', repository=repository)
-            elif custom_unit == 'weeks' and (custom_interval < 1 or custom_interval > 52):
-                flash('Custom interval for weeks must be between 1 and 52', 'error')
-                return render_template('edit_repository.html', repository=repository)
-            elif custom_unit == 'months' and (custom_interval < 1 or custom_interval > 12):
-                flash('Custom interval for months must be between 1 and 12', 'error')
-                return render_template('edit_repository.html', repository=repository)
-            
-            repository.custom_interval = custom_interval
-            repository.custom_unit = custom_unit
-            
-            try:
-                time_parts = custom_time.split(':')
-                repository.custom_hour = int(time_parts[0])
-                repository.custom_minute = int(time_parts[1])
-                
-                if repository.custom_hour < 0 or repository.custom_hour > 23:
-                    flash('Hour must be between 0 and 23', 'error')
-                    return render_template('edit_repository.html', repository=repository)
-                if repository.custom_minute < 0 or repository.custom_minute > 59:
-                    flash('Minute must be between 0 and 59', 'error')
-                    return render_template('edit_repository.html', repository=repository)
-                    
-            except (IndexError, ValueError):
-                flash('Invalid time format. Please use HH:MM format', 'error')
-                return render_template('edit_repository.html', repository=repository)
-        else:
-            # Reset custom fields when not using custom schedule
-            repository.custom_interval = None
-            repository.custom_unit = None
-            repository.custom_hour = 2
-            repository.custom_minute = 0
-        
-        db.session.commit()
-        
-        # Reschedule the backup job - more robust approach
-        job_id = f'backup_{repo_id}'
-        try:
-            # Remove job if it exists
-            if scheduler.get_job(job_id):
-                scheduler.remove_job(job_id)
-                logger.info(f"Removed existing job during edit: {job_id}")
-        except Exception as e:
-            logger.warning(f"Could not remove job during edit {job_id}: {e}")
-        
-        # Wait a moment to ensure job removal is complete
-        import time
-        time.sleep(0.1)
-        
-        if repository.is_active and repository.schedule_type != 'manual':
-            schedule_backup_job(repository)
-            logger.info(f"Rescheduled job for repository: {repository.name}")
-        
-        flash('Repository updated successfully', 'success')
-        return redirect(url_for('repositories'))
-    
-    return render_template('edit_repository.html', repository=repository)
-
-@app.route('/repositories/<int:repo_id>/delete', methods=['POST'])
-@login_required
-def delete_repository(repo_id):
-    repository = Repository.query.filter_by(id=repo_id, user_id=current_user.id).first_or_404()
-    
-    # Remove scheduled job
-    try:
-        scheduler.remove_job(f'backup_{repo_id}')
-    except:
-        pass
-    
-    db.session.delete(repository)
-    db.session.commit()
-    
-    flash('Repository deleted successfully', 'success')
-    return redirect(url_for('repositories'))
-
-@app.route('/repositories/delete-all', methods=['POST'])
-@login_required
-def delete_all_repositories():
-    """Delete all repositories for the current user"""
-    repositories = Repository.query.filter_by(user_id=current_user.id).all()
-    
-    if not repositories:
-        flash('No repositories to delete', 'info')
-        return redirect(url_for('repositories'))
-    
-    deleted_count = 0
-    
-    for repository in repositories:
-        try:
-            # Remove scheduled job
-            try:
-                scheduler.remove_job(f'backup_{repository.id}')
-                logger.info(f"Removed scheduled job for repository {repository.id}")
-            except:
-                pass
-            
-            db.session.delete(repository)
-            deleted_count += 1
-            logger.info(f"Deleted repository: {repository.name}")
-        except Exception as e:
-            logger.error(f"Failed to delete repository {repository.id}: {str(e)}")
-            continue
-    
-    if deleted_count > 0:
-        db.session.commit()
-        flash(f'Deleted {deleted_count} repository/repositories successfully', 'success')
-        logger.info(f"Deleted {deleted_count} repositories for user {current_user.id}")
-    else:
-        flash('Failed to delete repositories', 'error')
-    
-    return redirect(url_for('repositories'))
-
-@app.route('/repositories/<int:repo_id>/backup', methods=['POST'])
-@login_required
-def manual_backup(repo_id):
-    repository = Repository.query.filter_by(id=repo_id, user_id=current_user.id).first_or_404()
-    
-    try:
-        # Manual backups are already in app context, so no wrapper needed
-        backup_service.backup_repository(repository)
-        flash('Backup started successfully', 'success')
-    except Exception as e:
-        logger.error(f"Manual backup failed: {str(e)}")
-        flash('Backup failed. Check logs for details.', 'error')
-    
-    return redirect(url_for('repositories'))
-
-@app.route('/repositories/backup-all', methods=['POST'])
-@login_required
-def backup_all_repositories():
-    """Trigger backups for all active repositories"""
-    repositories = Repository.query.filter_by(user_id=current_user.id, is_active=True).all()
-    
-    if not repositories:
-        flash('No active repositories to backup', 'info')
-        return redirect(url_for('repositories'))
-    
-    backup_count = 0
-    error_count = 0
-    
-    for repository in repositories:
-        try:
-            backup_service.backup_repository(repository)
-            backup_count += 1
-            logger.info(f"Triggered backup for repository: {repository.name}")
-        except Exception as e:
-            error_count += 1
-            logger.error(f"Failed to trigger backup for {repository.name}: {str(e)}")
-    
-    if error_count == 0:
-        flash(f'Started backup for {backup_count} repositories', 'success')
-    else:
-        flash(f'Started backup for {backup_count} repositories ({error_count} failed)', 'warning')
-    
-    return redirect(url_for('repositories'))
-
-@app.route('/jobs')
-@login_required
-def backup_jobs():
-    jobs = BackupJob.query.filter_by(user_id=current_user.id).order_by(BackupJob.created_at.desc()).all()
-    has_running = any(job.status == 'running' for job in jobs)
-    return render_template('backup_jobs.html', jobs=jobs, has_running=has_running)
-
-@app.route('/health')
-def health_check():
-    local_time = datetime.now(LOCAL_TZ)
-    utc_time = datetime.utcnow()
-    return jsonify({
-        'status': 'healthy', 
-        'utc_time': utc_time.isoformat(),
-        'local_time': local_time.isoformat(),
-        'timezone': str(LOCAL_TZ),
-        'timezone_name': local_time.strftime('%Z')
-    })
-
-@app.route('/api/scheduler/status')
-@login_required
-def scheduler_status():
-    """Debug endpoint to check scheduled jobs"""
-    jobs = []
-    for job in scheduler.get_jobs():
-        jobs.append({
-            'id': job.id,
-            'name': job.name,
-            'next_run': job.next_run_time.isoformat() if job.next_run_time else None,
-            'trigger': str(job.trigger)
-        })
-    return jsonify({
-        'scheduler_running': scheduler.running,
-        'scheduled_jobs': jobs,
-        'total_jobs': len(jobs)
-    })
-
-@app.route('/api/test-backup/<int:repo_id>', methods=['POST'])
-@login_required
-def test_scheduled_backup(repo_id):
-    """Test endpoint to simulate a scheduled backup (for debugging)"""
-    repository = Repository.query.filter_by(id=repo_id, user_id=current_user.id).first_or_404()
-    
-    def test_backup_with_context():
-        with app.app_context():
-            try:
-                # Refresh the repository object to ensure it's bound to the current session
-                repo = Repository.query.get(repository.id)
-                if repo and repo.is_active:
-                    backup_service.backup_repository(repo)
-                    return "Backup completed successfully"
-                else:
-                    return f"Repository {repository.id} not found or inactive"
-            except Exception as e:
-                logger.error(f"Error in test backup for repository {repository.id}: {e}", exc_info=True)
-                return "An internal error occurred during the backup operation."
-    
-    try:
-        result = test_backup_with_context()
-        return jsonify({'success': True, 'message': result})
-    except Exception as e:
-        logger.error(f"Error in /api/test-backup endpoint for repository {repo_id}: {e}", exc_info=True)
-        return jsonify({'success': False, 'error': 'An internal error occurred.'}), 500
-
-@app.route('/api/theme', methods=['POST'])
-@login_required
-def update_theme():
-    data = request.get_json()
-    theme = data.get('theme')
-    
-    if theme in ['dark', 'light']:
-        current_user.theme = theme
-        db.session.commit()
-        return jsonify({'success': True, 'theme': theme})
-    
-    return jsonify({'success': False, 'error': 'Invalid theme'}), 400
-
-@app.route('/favicon.ico')
-def favicon():
-    return send_from_directory(os.path.join(app.root_path, 'static', 'img'), 'ghbackup_ico.ico', mimetype='image/vnd.microsoft.icon')
-
-def schedule_backup_job(repository):
-    """Schedule a backup job for a repository"""
-    global _scheduled_jobs
-    
-    if not repository.is_active:
-        logger.info(f"Repository {repository.name} is inactive, not scheduling")
-        return
-    
-    job_id = f'backup_{repository.id}'
-    
-    # Thread-safe check to prevent duplicate scheduling
-    with _job_tracking_lock:
-        if job_id in _scheduled_jobs:
-            logger.warning(f"Job {job_id} already being scheduled, skipping duplicate")
-            return
-        
-        # Mark this job as being scheduled
-        _scheduled_jobs.add(job_id)
-    
-    logger.info(f"Attempting to schedule job {job_id} for repository {repository.name}")
-    
-    # Remove existing job if it exists - try multiple ways to ensure it's gone
-    try:
-        existing_job = scheduler.get_job(job_id)
-        if existing_job:
-            scheduler.remove_job(job_id)
-            logger.info(f"Removed existing scheduled job: {job_id}")
-            # Also remove from our tracking
-            with _job_tracking_lock:
-                _scheduled_jobs.discard(job_id)
-        else:
-            logger.info(f"No existing job found for {job_id}")
-    except Exception as e:
-        logger.warning(f"Could not remove existing job {job_id}: {e}")
-    
-    # Double-check that job is really gone
-    if scheduler.get_job(job_id):
-        logger.error(f"Job {job_id} still exists after removal attempt, aborting schedule")
-        with _job_tracking_lock:
-            _scheduled_jobs.discard(job_id)
-        return
-    
-    # Create a wrapper function that includes Flask app context
-    def backup_with_context():
-        from datetime import datetime, timedelta  # Import inside function for closure scope
-        
-        with app.app_context():
-            try:
-                # Refresh the repository object to ensure it's bound to the current session
-                repo = Repository.query.get(repository.id)
-                if not repo or not repo.is_active:
-                    logger.warning(f"Repository {repository.id} not found or inactive, skipping backup")
-                    return
-                
-                # Multiple layers of duplicate prevention
-                
-                # 0. Auto-cleanup: Mark any long-running jobs as failed
-                stuck_cutoff = datetime.utcnow() - timedelta(hours=2)
-                stuck_jobs = BackupJob.query.filter_by(
-                    repository_id=repository.id,
-                    status='running'
-                ).filter(
-                    BackupJob.started_at < stuck_cutoff
-                ).all()
-                
-                if stuck_jobs:
-                    logger.warning(f"Found {len(stuck_jobs)} stuck running jobs for repository {repo.name}, cleaning up")
-                    for stuck in stuck_jobs:
-                        stuck.status = 'failed'
-                        stuck.error_message = 'Job stuck for over 2 hours, automatically failed'
-                        stuck.completed_at = datetime.utcnow()
-                    db.session.commit()
-                
-                # 1. Check if there's already a running backup for this repository
-                running_job = BackupJob.query.filter_by(
-                    repository_id=repository.id, 
-                    status='running'
-                ).first()
-                
-                if running_job:
-                    logger.warning(f"Backup already running for repository {repo.name} (job {running_job.id}), skipping")
-                    return
-                
-                # 2. Check for very recent backups (within last 2 minutes) to prevent rapid duplicates
-                recent_cutoff = datetime.utcnow() - timedelta(minutes=2)
-                recent_backup = BackupJob.query.filter_by(
-                    repository_id=repository.id
-                ).filter(
-                    BackupJob.started_at > recent_cutoff
-                ).first()
-                
-                if recent_backup:
-                    logger.warning(f"Recent backup found for repository {repo.name} (started at {recent_backup.started_at}), skipping to prevent duplicates")
-                    return
-                
-                # 3. Use a file-based lock to prevent concurrent executions
-                import fcntl
-                import tempfile
-                import os
-                
-                lock_file_path = os.path.join(tempfile.gettempdir(), f"backup_lock_{repository.id}")
-                
-                try:
-                    lock_file = open(lock_file_path, 'w')
-                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    logger.info(f"Acquired file lock for repository {repo.name}")
-                    
-                    try:
-                        logger.info(f"Starting scheduled backup for repository: {repo.name}")
-                        backup_service.backup_repository(repo)
-                        logger.info(f"Completed scheduled backup for repository: {repo.name}")
-                    finally:
-                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
-                        lock_file.close()
-                        try:
-                            os.unlink(lock_file_path)
-                        except:
-                            pass
-                        
-                except (IOError, OSError) as lock_error:
-                    logger.warning(f"Could not acquire lock for repository {repo.name}, another backup may be running: {lock_error}")
-                    return
-                
-            except Exception as e:
-                logger.error(f"Error in scheduled backup for repository {repository.id}: {e}", exc_info=True)
-    
-    # Create new schedule based on schedule_type
-    if repository.schedule_type == 'hourly':
-        trigger = CronTrigger(minute=0, timezone=LOCAL_TZ)
-    elif repository.schedule_type == 'daily':
-        trigger = CronTrigger(hour=2, minute=0, timezone=LOCAL_TZ)  # 2 AM local time
-    elif repository.schedule_type == 'weekly':
-        trigger = CronTrigger(day_of_week=0, hour=2, minute=0, timezone=LOCAL_TZ)  # Sunday 2 AM local time
-    elif repository.schedule_type == 'monthly':
-        trigger = CronTrigger(day=1, hour=2, minute=0, timezone=LOCAL_TZ)  # 1st of month 2 AM local time
-    elif repository.schedule_type == 'custom':
-        # Handle custom schedule
-        hour = repository.custom_hour or 2
-        minute = repository.custom_minute or 0
-        interval = repository.custom_interval or 1
-        unit = repository.custom_unit or 'days'
-        
-        if unit == 'days':
-            # For daily intervals, use interval_trigger if more than 1 day
-            if interval == 1:
-                trigger = CronTrigger(hour=hour, minute=minute, timezone=LOCAL_TZ)  # Daily
-            else:
-                # Use interval trigger for multi-day schedules
-                from apscheduler.triggers.interval import IntervalTrigger
-                from datetime import datetime, time
-                # Calculate next run time at the specified hour/minute in local timezone
-                now = datetime.now(LOCAL_TZ)
-                start_date = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-                if start_date <= now:
-                    start_date = start_date + timedelta(days=1)
-                trigger = IntervalTrigger(days=interval, start_date=start_date, timezone=LOCAL_TZ)
-        elif unit == 'weeks':
-            # For weekly intervals
-            if interval == 1:
-                trigger = CronTrigger(day_of_week=0, hour=hour, minute=minute, timezone=LOCAL_TZ)  # Every Sunday
-            else:
-                from apscheduler.triggers.interval import IntervalTrigger
-                from datetime import datetime
-                now = datetime.now(LOCAL_TZ)
-                start_date = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-                # Find next Sunday
-                days_until_sunday = (6 - now.weekday()) % 7
-                if days_until_sunday == 0 and start_date <= now:
-                    days_until_sunday = 7
-                start_date = start_date + timedelta(days=days_until_sunday)
-                trigger = IntervalTrigger(weeks=interval, start_date=start_date, timezone=LOCAL_TZ)
-        elif unit == 'months':
-            # For monthly intervals
-            if interval == 1:
-                trigger = CronTrigger(day=1, hour=hour, minute=minute, timezone=LOCAL_TZ)  # 1st of every month
-            else:
-                from apscheduler.triggers.interval import IntervalTrigger
-                from datetime import datetime
-                now = datetime.now(LOCAL_TZ)
-                start_date = now.replace(day=1, hour=hour, minute=minute, second=0, microsecond=0)
-                if start_date <= now:
-                    # Move to next month
-                    if start_date.month == 12:
-                        start_date = start_date.replace(year=start_date.year + 1, month=1)
-                    else:
-                        start_date = start_date.replace(month=start_date.month + 1)
-                # Note: Using weeks approximation for months since APScheduler doesn't have months interval
-                trigger = IntervalTrigger(weeks=interval*4, start_date=start_date, timezone=LOCAL_TZ)
-        else:
-            return  # Invalid unit
-    else:
-        return  # Manual only
-    
-    scheduler.add_job(
-        func=backup_with_context,
-        trigger=trigger,
-        id=job_id,
-        name=f'Backup {repository.name}',
-        replace_existing=True,
-        misfire_grace_time=60,  # Reduced from 5 minutes to 1 minute
-        coalesce=True,  # Combine multiple pending executions
-        max_instances=1  # Only one instance of this specific job can run
-    )
-    
-    logger.info(f"Successfully scheduled backup job for {repository.name} with trigger: {trigger}")
-    
-    # Verify the job was actually added
-    added_job = scheduler.get_job(job_id)
-    if added_job:
-        logger.info(f"Job {job_id} successfully scheduled, next run: {added_job.next_run_time}")
-    else:
-        logger.error(f"Failed to schedule job {job_id} - job not found after creation")
-        # Remove from tracking if scheduling failed
-        with _job_tracking_lock:
-            _scheduled_jobs.discard(job_id)
-
-# Initialize scheduler with existing repositories at startup
-# This runs after all functions are defined
-if not globals().get('_scheduler_startup_completed', False):
-    try:
-        with app.app_context():
-            logger.info("Starting scheduler initialization at app startup...")
-            
-            # Log current scheduler state
-            existing_jobs = scheduler.get_jobs()
-            logger.info(f"Scheduler has {len(existing_jobs)} existing jobs before initialization")
-            
-            ensure_scheduler_initialized()
-            
-            # Log final state
-            final_jobs = scheduler.get_jobs()
-            backup_jobs = [job for job in final_jobs if job.id.startswith('backup_')]
-            logger.info(f"Scheduler initialization completed. Total jobs: {len(final_jobs)}, Backup jobs: {len(backup_jobs)}")
-            
-            for job in backup_jobs:
-                logger.info(f"Scheduled job: {job.id} -> next run: {job.next_run_time}")
-            
-            globals()['_scheduler_startup_completed'] = True
-            
-    except Exception as e:
-        logger.error(f"Failed to initialize scheduler at startup: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
-else:
-    logger.info("Scheduler startup initialization skipped - already completed")
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=False)
+import os
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+import pytz
+import time
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, jsonify, send_from_directory, abort, session
+from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from flask_sqlalchemy import SQLAlchemy
+from werkzeug.security import generate_password_hash, check_password_hash
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+import logging
+from backup_service import BackupService
+from models import db, User, Repository, BackupJob, PasswordResetCode
+import atexit
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('/app/logs/app.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+# Set APScheduler logging level to WARNING to reduce noise
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+app = Flask(__name__)
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:////app/data/github_backup.db')
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Behind the reverse proxy DEPLOYMENT.md recommends, remote_addr is the
+# proxy's address for every client; opt in to trusting one X-Forwarded-For
+# hop so per-client logic (login rate limiting) sees real addresses.
+# Off by default - honoring the header without a proxy lets clients spoof it.
+if os.environ.get('TRUST_PROXY', 'false').lower() in ('true', '1', 'yes'):
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1)
+
+# Explicit engine pooling so scheduler threads and web requests don't
+# serialize on a single connection (Flask-SQLAlchemy defaults are unsized)
+engine_options = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_timeout': 30,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    # LIFO reuse keeps a hot subset of connections busy so idle overflow
+    # connections age out instead of being round-robined
+    'pool_use_lifo': True,
+    # Room for every distinct statement the app issues, so repeated page
+    # loads reuse compiled SQL instead of re-compiling it
+    'query_cache_size': 1200,
+}
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # Allow the APScheduler thread to share pooled SQLite connections
+    engine_options['connect_args'] = {'check_same_thread': False, 'timeout': 30}
+    if ':memory:' in app.config['SQLALCHEMY_DATABASE_URI']:
+        # In-memory databases get a StaticPool, which takes no sizing args
+        for _opt in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_use_lifo'):
+            engine_options.pop(_opt, None)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+
+# Persist compiled Jinja bytecode so templates are only parsed once per
+# deploy instead of once per worker start
+from jinja2 import FileSystemBytecodeCache
+_jinja_cache_dir = os.environ.get('JINJA_CACHE_DIR', '/app/data/jinja_cache')
+try:
+    os.makedirs(_jinja_cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_jinja_cache_dir)
+except OSError as e:
+    logger.warning(f"Jinja bytecode cache disabled ({e})")
+
+# Ensure the SQLite directory exists; make_url handles both the relative
+# (sqlite:///) and absolute (sqlite:////) forms without string surgery
+db_uri = app.config['SQLALCHEMY_DATABASE_URI']
+logger.info(f"Configured DB URI: {db_uri}")
+if db_uri.startswith('sqlite'):
+    from sqlalchemy.engine.url import make_url
+    sqlite_file = make_url(db_uri).database
+    parent = os.path.dirname(os.path.abspath(sqlite_file)) if sqlite_file else ''
+    if parent:
+        try:
+            os.makedirs(parent, exist_ok=True)
+            if logger.isEnabledFor(logging.DEBUG):
+                # Permission detail is only worth the extra stat when debugging
+                stat_parent = os.stat(parent)
+                logger.debug(f"SQLite file target: {sqlite_file} (parent exists, perms {oct(stat_parent.st_mode)[-3:]})")
+        except Exception as e:
+            logger.error(f"Failed ensuring SQLite directory {parent}: {e}")
+
+# Initialize extensions
+db.init_app(app)
+
+# SQLite PRAGMA tuning - applied on every new DBAPI connection.
+# WAL lets the dashboard read while a backup job commits, and
+# synchronous=NORMAL avoids a full fsync on every db.session.commit().
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_conn, connection_record):
+    # Only applies to SQLite; harmless no-op if DATABASE_URL points elsewhere
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cursor = dbapi_conn.cursor()
+    for pragma in (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=30000",
+        "PRAGMA cache_size=-20000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA mmap_size=134217728",  # 128MB: page reads via mmap instead of read() syscalls
+        "PRAGMA foreign_keys=ON",
+    ):
+        cursor.execute(pragma)
+    cursor.close()
+
+import functools
+
+@functools.lru_cache(maxsize=None)
+def _tz(name):
+    """Memoized pytz.timezone lookup (tz database parsing is not free)"""
+    return pytz.timezone(name)
+
+# Common timezone abbreviations -> tz database names. Module-level constant
+# so repeated timezone lookups don't rebuild the dict
+_TZ_ABBREV_MAP = {
+    'CET': 'Europe/Amsterdam',
+    'CEST': 'Europe/Amsterdam',
+    'EST': 'America/New_York',
+    'EDT': 'America/New_York',
+    'PST': 'America/Los_Angeles',
+    'PDT': 'America/Los_Angeles',
+    'UTC': 'UTC',
+    'GMT': 'UTC'
+}
+
+# Configure local timezone detection (cached: env and system tz are fixed
+# for the process lifetime, so detection runs exactly once)
+@functools.lru_cache(maxsize=1)
+def get_local_timezone():
+    """Detect the local system timezone"""
+    # Try environment variable first (Docker/container support)
+    tz_env = os.environ.get('TZ')
+    if tz_env:
+        try:
+            return _tz(tz_env)
+        except pytz.UnknownTimeZoneError:
+            logger.warning(f"Unknown timezone in TZ environment variable: {tz_env}")
+    
+    # Try system timezone
+    try:
+        # Get system timezone
+        local_tz_name = time.tzname[time.daylight] if time.daylight else time.tzname[0]
+        if local_tz_name:
+            # Try to map common abbreviations to full timezone names
+            full_tz_name = _TZ_ABBREV_MAP.get(local_tz_name, local_tz_name)
+            return _tz(full_tz_name)
+    except:
+        pass
+    
+    # Fallback to UTC
+    logger.warning("Could not detect local timezone, using UTC")
+    return pytz.UTC
+
+LOCAL_TZ = get_local_timezone()
+logger.info(f"Using timezone: {LOCAL_TZ}")
+
+# Constants for the per-row time filters: templates call these for every
+# rendered job/repository, so avoid re-deriving them each call
+_UTC = pytz.utc
+_LOCAL_TZ_FALLBACK_NAME = getattr(LOCAL_TZ, 'zone', str(LOCAL_TZ)).rsplit('/', 1)[-1]
+
+# Cron triggers for the fixed schedule types are immutable and identical for
+# every repository, so build them once instead of on each schedule call
+_TRIGGERS = {
+    'hourly': CronTrigger(minute=0, timezone=LOCAL_TZ),
+    'daily': CronTrigger(hour=2, minute=0, timezone=LOCAL_TZ),  # 2 AM local time
+    'weekly': CronTrigger(day_of_week=0, hour=2, minute=0, timezone=LOCAL_TZ),  # Sunday 2 AM local time
+    'monthly': CronTrigger(day=1, hour=2, minute=0, timezone=LOCAL_TZ),  # 1st of month 2 AM local time
+}
+
+@functools.lru_cache(maxsize=256)
+def _custom_trigger(hour, minute, interval, unit, now_bucket):
+    """Build (and memoize) the trigger for a custom schedule.
+
+    Triggers are immutable for a given parameter tuple, so repositories
+    sharing a schedule reuse one object instead of re-parsing cron fields.
+    `now_bucket` (hour granularity) scopes entries whose start_date depends
+    on the current time, so stale start dates age out within the hour.
+    Returns None for an unknown unit.
+    """
+    if unit == 'days':
+        # For daily intervals, use interval_trigger if more than 1 day
+        if interval == 1:
+            return CronTrigger(hour=hour, minute=minute, timezone=LOCAL_TZ)  # Daily
+        # Calculate next run time at the specified hour/minute in local timezone
+        now = datetime.now(LOCAL_TZ)
+        start_date = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if start_date <= now:
+            start_date = start_date + timedelta(days=1)
+        return IntervalTrigger(days=interval, start_date=start_date, timezone=LOCAL_TZ)
+    if unit == 'weeks':
+        if interval == 1:
+            return CronTrigger(day_of_week=0, hour=hour, minute=minute, timezone=LOCAL_TZ)  # Every Sunday
+        now = datetime.now(LOCAL_TZ)
+        start_date = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        # Find next Sunday
+        days_until_sunday = (6 - now.weekday()) % 7
+        if days_until_sunday == 0 and start_date <= now:
+            days_until_sunday = 7
+        start_date = start_date + timedelta(days=days_until_sunday)
+        return IntervalTrigger(weeks=interval, start_date=start_date, timezone=LOCAL_TZ)
+    if unit == 'months':
+        if interval == 1:
+            return CronTrigger(day=1, hour=hour, minute=minute, timezone=LOCAL_TZ)  # 1st of every month
+        now = datetime.now(LOCAL_TZ)
+        start_date = now.replace(day=1, hour=hour, minute=minute, second=0, microsecond=0)
+        if start_date <= now:
+            # Move to next month
+            if start_date.month == 12:
+                start_date = start_date.replace(year=start_date.year + 1, month=1)
+            else:
+                start_date = start_date.replace(month=start_date.month + 1)
+        # Note: Using weeks approximation for months since APScheduler doesn't have months interval
+        return IntervalTrigger(weeks=interval * 4, start_date=start_date, timezone=LOCAL_TZ)
+    return None  # Invalid unit
+
+@functools.lru_cache(maxsize=4096)
+def to_local_time(utc_dt):
+    """Convert UTC datetime to local time.
+
+    Memoized: identical timestamps repeat across dashboard/jobs cells
+    (created_at shown in several columns, batch-created jobs), and pytz
+    astimezone arithmetic is the expensive part of each render.
+    """
+    if utc_dt is None:
+        return None
+    if utc_dt.tzinfo is None:
+        # Assume UTC if no timezone info; replace() is cheaper than localize()
+        # and equivalent for the fixed-offset UTC zone
+        utc_dt = utc_dt.replace(tzinfo=_UTC)
+    return utc_dt.astimezone(LOCAL_TZ)
+
+# Add Jinja2 filters
+@app.template_filter('local_time')
+def local_time_filter(utc_dt):
+    """Jinja2 filter to convert UTC time to local time"""
+    return to_local_time(utc_dt)
+
+@app.template_filter('format_local_time')
+def format_local_time_filter(utc_dt, format_str='%Y-%m-%d %H:%M'):
+    """Jinja2 filter to format UTC time as local time"""
+    local_dt = to_local_time(utc_dt)
+    if local_dt is None:
+        return "Never"
+
+    # tzname() is a plain attribute lookup on the pytz zone (DST-aware),
+    # saving the second strftime('%Z') pass per rendered row
+    tz_name = local_dt.tzname() or _LOCAL_TZ_FALLBACK_NAME
+
+    return local_dt.strftime(format_str) + ' ' + tz_name
+
+from sqlalchemy import text
+
+login_manager = LoginManager()
+login_manager.init_app(app)
+login_manager.login_view = 'login'
+
+# Initialize backup service
+backup_service = BackupService()
+
+# Initialize scheduler with a persistent job store so schedules survive
+# container restarts instead of silently vanishing until each repo is edited
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.executors.pool import ThreadPoolExecutor
+
+jobstores = {
+    'default': SQLAlchemyJobStore(url=app.config['SQLALCHEMY_DATABASE_URI'])
+}
+# Backups are I/O-bound (clone + compress), so run them in parallel and
+# scale with the host; coalesce/max_instances below still prevent
+# per-repo stampedes. BACKUP_MAX_WORKERS overrides the heuristic.
+_backup_max_workers = int(os.environ.get(
+    'BACKUP_MAX_WORKERS', min(32, (os.cpu_count() or 2) * 4)))
+logger.info(f"Scheduler executor sized at {_backup_max_workers} workers")
+executors = {
+    'default': ThreadPoolExecutor(max_workers=_backup_max_workers)
+}
+job_defaults = {
+    'coalesce': True,  # Combine multiple pending executions of the same job
+    'max_instances': 1,  # Only one instance of a job can run at a time
+    'misfire_grace_time': 60  # 1 minute grace time for missed jobs
+}
+
+scheduler = BackgroundScheduler(
+    jobstores=jobstores,
+    executors=executors,
+    job_defaults=job_defaults,
+    timezone=LOCAL_TZ
+)
+# Note: scheduler.start() happens in the startup block at the bottom of this
+# module - restoring persisted jobs needs all job functions defined first
+
+def scheduler_health_check():
+    """Periodic job: purge old failed backup jobs.
+
+    Duplicate-job detection used to live here too; the persistent job store
+    enforces uniqueness by job id, so that repair logic is gone.
+    """
+    with app.app_context():
+        try:
+            # Auto-cleanup old failed jobs (older than 7 days) in one DELETE
+            # instead of loading rows just to delete them one by one
+            old_cutoff = datetime.utcnow() - timedelta(days=7)
+            with _db_write_lock:
+                old_count = BackupJob.query.filter(
+                    BackupJob.status == 'failed',
+                    BackupJob.created_at < old_cutoff
+                ).delete(synchronize_session=False)
+                db.session.commit()
+            if old_count:
+                logger.info(f"Auto-cleaned {old_count} old failed backup jobs")
+
+            # Purge used and expired password-reset codes so code lookups
+            # stay on a small table no matter how long the instance runs
+            from sqlalchemy import or_
+            reset_cutoff = datetime.utcnow() - _RESET_CODE_TTL
+            with _db_write_lock:
+                code_count = PasswordResetCode.query.filter(or_(
+                    PasswordResetCode.used == True,
+                    PasswordResetCode.created_at < reset_cutoff,
+                )).delete(synchronize_session=False)
+                db.session.commit()
+            if code_count:
+                logger.info(f"Purged {code_count} stale password reset codes")
+
+        except Exception as e:
+            logger.error(f"Scheduler health check failed: {e}")
+
+def schedule_all_repositories():
+    """Schedule all active repositories on startup"""
+    try:
+        # One clock read reused for every timestamp in this pass
+        now = datetime.utcnow()
+
+        # Clean up any stuck 'running' jobs from previous sessions with a
+        # single bulk UPDATE (one statement, one writer-lock acquisition)
+        with _db_write_lock:
+            stuck_count = BackupJob.query.filter_by(status='running').update({
+                'status': 'failed',
+                'error_message': 'Job was running when application restarted',
+                'completed_at': now,
+            }, synchronize_session=False)
+            db.session.commit()
+        if stuck_count:
+            logger.warning(f"Marked {stuck_count} stuck 'running' jobs from previous session as failed")
+
+        # Auto-cleanup: Remove duplicate backup jobs created within last hour
+        cutoff = now - timedelta(hours=1)
+        recent_jobs = BackupJob.query.filter(BackupJob.created_at > cutoff).all()
+        
+        # Group by repository and find duplicates
+        repo_jobs = {}
+        for job in recent_jobs:
+            repo_id = job.repository_id
+            if repo_id not in repo_jobs:
+                repo_jobs[repo_id] = []
+            repo_jobs[repo_id].append(job)
+        
+        duplicate_ids = []
+        for repo_id, jobs in repo_jobs.items():
+            if len(jobs) > 1:
+                # Sort by creation time, keep the first one, mark others as failed
+                jobs.sort(key=lambda j: j.created_at)
+                duplicate_ids.extend(
+                    j.id for j in jobs[1:] if j.status in ('pending', 'running'))
+
+        if duplicate_ids:
+            # One bulk UPDATE for all duplicates instead of a flush per row
+            with _db_write_lock:
+                BackupJob.query.filter(BackupJob.id.in_(duplicate_ids)).update({
+                    'status': 'failed',
+                    'error_message': 'Duplicate job automatically cleaned up',
+                    'completed_at': now,
+                }, synchronize_session=False)
+                db.session.commit()
+            logger.info(f"Auto-cleaned {len(duplicate_ids)} duplicate backup jobs: {duplicate_ids}")
+
+        # Reconcile the persistent job store against the repository table:
+        # drop orphaned jobs, then add only the schedules that are missing.
+        # Jobs already in the store survived the restart and need no work.
+        # Only the scheduling columns are materialized - backup tokens/URLs
+        # are dead weight for trigger construction.
+        existing_ids = {job.id for job in scheduler.get_jobs() if job.id.startswith('backup_')}
+        repositories = Repository.query.options(db.load_only(
+            Repository.id, Repository.name, Repository.is_active,
+            Repository.schedule_type, Repository.custom_interval,
+            Repository.custom_unit, Repository.custom_hour,
+            Repository.custom_minute,
+        )).filter_by(is_active=True).all()
+        desired_ids = {f'backup_{r.id}' for r in repositories if r.schedule_type != 'manual'}
+
+        # Pausing batches all store modifications under one wakeup cycle
+        # instead of recomputing the wakeup deadline per job
+        was_running = scheduler.running
+        if was_running:
+            scheduler.pause()
+        try:
+            for orphan_id in existing_ids - desired_ids:
+                try:
+                    scheduler.remove_job(orphan_id)
+                    logger.info(f"Removed orphaned job on startup: {orphan_id}")
+                except JobLookupError:
+                    pass
+
+            scheduled_count = 0
+            for repository in repositories:
+                if repository.schedule_type != 'manual' and f'backup_{repository.id}' not in existing_ids:
+                    schedule_backup_job(repository)
+                    scheduled_count += 1
+                    logger.info(f"Scheduled backup job for repository: {repository.name} ({repository.schedule_type})")
+        finally:
+            if was_running:
+                scheduler.resume()
+        logger.info(f"Scheduled {scheduled_count} missing backup jobs on startup "
+                    f"({len(existing_ids & desired_ids)} restored from the job store)")
+        
+        # Schedule health check to run every 6 hours
+        scheduler.add_job(
+            func=scheduler_health_check,
+            trigger=CronTrigger(hour='*/6', timezone=LOCAL_TZ),
+            id='scheduler_health_check',
+            name='Scheduler Health Check',
+            replace_existing=True,
+            misfire_grace_time=300,
+            coalesce=True,
+            max_instances=1
+        )
+        logger.info("Scheduled periodic scheduler health check")
+        
+    except Exception as e:
+        logger.error(f"Error scheduling repositories on startup: {e}")
+
+# Thread-safe flag to ensure we only initialize once
+import threading
+_scheduler_lock = threading.Lock()
+_scheduler_initialized = False
+
+# One lock per repository id; dict.setdefault is atomic under the GIL so
+# concurrent first-time ticks for the same repo still share one lock
+_repo_backup_locks = {}
+
+# Serializes multi-statement write sections (scheduler threads + requests)
+# inside this process so concurrent writers queue here instead of holding
+# pooled connections while blocked on SQLite's single writer lock
+_db_write_lock = threading.Lock()
+
+def ensure_scheduler_initialized():
+    """Ensure scheduler is initialized with existing repositories (thread-safe)"""
+    global _scheduler_initialized
+    if _scheduler_initialized:
+        return
+        
+    with _scheduler_lock:
+        # Double-check pattern to avoid race conditions
+        if not _scheduler_initialized:
+            logger.info("Initializing scheduler with existing repositories...")
+            schedule_all_repositories()
+            _scheduler_initialized = True
+            logger.info("Scheduler initialization completed")
+
+# Short-lived cache of User rows so every authenticated request doesn't
+# re-issue SELECT * FROM user. Mutating views must pop the entry on commit.
+from flask import g
+from cachetools import TTLCache
+from sqlalchemy import inspect as sa_inspect
+
+# TTLCache is not thread-safe, and these caches are shared between gunicorn
+# request threads and scheduler executor threads. One lock covers all of
+# them; the guarded sections are plain dict operations, never queries.
+_cache_lock = threading.Lock()
+
+_user_cache = TTLCache(maxsize=1024, ttl=60)
+
+def _invalidate_user_cache(user_id):
+    """Drop a cached User after its row has been modified"""
+    with _cache_lock:
+        _user_cache.pop(user_id, None)
+
+# Short TTL cache for the dashboard and jobs page query results. Backups
+# only change state on a schedule, so repeated refreshes can skip the DB.
+_page_cache = TTLCache(maxsize=512, ttl=15)
+
+def get_user_repositories():
+    """Current user's repositories, memoized on g for the request lifetime"""
+    repos = g.get('_user_repositories')
+    if repos is None:
+        repos = Repository.query.filter_by(user_id=current_user.id).all()
+        g._user_repositories = repos
+    return repos
+
+def _invalidate_page_cache(user_id):
+    """Drop cached dashboard/jobs data after repositories or jobs change"""
+    with _cache_lock:
+        for key in list(_page_cache.keys()):
+            if len(key) >= 2 and key[1] == user_id:
+                _page_cache.pop(key, None)
+
+def is_admin():
+    """Session-backed admin check; falls back to the user row on a miss"""
+    flag = session.get('is_admin')
+    if flag is None and current_user.is_authenticated:
+        flag = bool(current_user.is_admin)
+        session['is_admin'] = flag
+    return bool(flag)
+
+@login_manager.user_loader
+def load_user(user_id):
+    uid = int(user_id)
+    # Request-scoped: Flask-Login can call the loader more than once per request
+    cached = g.get('_loaded_user')
+    if cached is not None and cached.id == uid:
+        return cached
+    with _cache_lock:
+        user = _user_cache.get(uid)
+    if user is not None and not sa_inspect(user).expired:
+        # Re-attach the cached instance to this request's session without a query
+        user = db.session.merge(user, load=False)
+    else:
+        user = db.session.get(User, uid)
+        if user is not None:
+            with _cache_lock:
+                _user_cache[uid] = user
+    g._loaded_user = user
+    return user
+
+@app.route('/')
+@login_required
+def dashboard():
+    uid = current_user.id  # resolve the LocalProxy once per request
+    cache_key = ('dash', uid)
+    with _cache_lock:
+        cached = _page_cache.get(cache_key)
+    if cached is not None:
+        repositories, recent_jobs = cached
+    else:
+        # Run both dashboard queries in one transaction; the (user_id, created_at)
+        # index on backup_job keeps the recent-jobs fetch index-only
+        from sqlalchemy import select
+        from sqlalchemy.orm import load_only
+        repositories = get_user_repositories()
+        # The recent-jobs panel only renders status/time/repo name, so skip
+        # hauling error_message TEXT and backup_path for every row;
+        # repository_id stays loaded for the selectin relationship
+        recent_jobs = db.session.execute(
+            select(BackupJob)
+            .options(load_only(BackupJob.status, BackupJob.created_at,
+                               BackupJob.repository_id))
+            .where(BackupJob.user_id == uid)
+            .order_by(BackupJob.created_at.desc())
+            .limit(10)
+        ).scalars().all()
+        with _cache_lock:
+            _page_cache[cache_key] = (repositories, recent_jobs)
+    # Stream the render so the browser gets the first bytes before the
+    # whole table has been formatted
+    return stream_template('dashboard.html', repositories=repositories, recent_jobs=recent_jobs)
+
+# Password hashing support. The dummy hash is verified whenever a login names
+# an unknown user, so "no such user" and "wrong password" take the same time
+# and usernames can't be enumerated via response timing. The small pool keeps
+# the ~100ms PBKDF2 work off the request thread's GIL slice.
+from concurrent.futures import ThreadPoolExecutor as _FuturesThreadPoolExecutor
+import hmac
+_DUMMY_HASH = generate_password_hash('dummy')
+_HASH_POOL = _FuturesThreadPoolExecutor(max_workers=2, thread_name_prefix='pwhash')
+
+def _hash_password(password):
+    """Hash a password on the shared executor"""
+    return _HASH_POOL.submit(generate_password_hash, password).result()
+
+# Short-TTL cache of verify results so credential replays (polling clients,
+# quick re-logins) don't re-run the full PBKDF2 derivation. Keys hold an
+# HMAC of the password under SECRET_KEY, never the password itself, and the
+# stored hash is part of the key so a password change invalidates naturally.
+_verify_cache = TTLCache(maxsize=1024, ttl=300)
+
+def _check_password_cached(stored_hash, password):
+    """check_password_hash with a short-lived replay cache"""
+    digest = hmac.new(app.secret_key.encode(), password.encode(), 'sha256').digest()
+    key = (stored_hash, digest)
+    with _cache_lock:
+        result = _verify_cache.get(key)
+    if result is None:
+        result = check_password_hash(stored_hash, password)
+        with _cache_lock:
+            _verify_cache[key] = result
+    return result
+
+# Cached "at least one user exists" flag so /login doesn't run a COUNT query
+# on every hit; flips to True permanently once the first user is created
+_has_any_user = None
+
+# Fixed-window rate limit for login attempts: a public endpoint running a
+# deliberately slow KDF is otherwise a free CPU-exhaustion vector. Keyed on
+# (address, username) so clients sharing one address - everyone, when the
+# app sits behind a reverse proxy without TRUST_PROXY - can't lock each
+# other out by burning a collective per-address budget.
+_LOGIN_RATE_LIMIT = 10   # attempts per window per (address, account) pair
+_LOGIN_RATE_WINDOW = 60  # seconds
+_login_attempts = {}
+_login_attempts_lock = threading.Lock()
+
+def _login_rate_limited(key):
+    """Count an attempt for key; True once the window budget is spent"""
+    global _login_attempts
+    now = time.time()
+    with _login_attempts_lock:
+        count, window_start = _login_attempts.get(key, (0, now))
+        if now - window_start >= _LOGIN_RATE_WINDOW:
+            count, window_start = 0, now
+        count += 1
+        _login_attempts[key] = (count, window_start)
+        if len(_login_attempts) > 1024:
+            # Drop expired windows so the map can't grow unbounded
+            _login_attempts = {k: v for k, v in _login_attempts.items()
+                               if now - v[1] < _LOGIN_RATE_WINDOW}
+        return count > _LOGIN_RATE_LIMIT
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    global _has_any_user
+    # Auto-create default admin if no users
+    if _has_any_user is None:
+        _has_any_user = db.session.query(User.id).limit(1).scalar() is not None
+    if not _has_any_user:
+        admin = User(username='admin', password_hash=generate_password_hash('changeme'), is_admin=True, theme='dark')
+        db.session.add(admin)
+        db.session.commit()
+        _has_any_user = True
+        logger.warning('Default admin user created with username=admin password=changeme; please change immediately.')
+    if request.method == 'POST':
+        username = request.form['username']
+        password = request.form['password']
+
+        # Reject over-budget clients before any KDF work is spent
+        if _login_rate_limited((request.remote_addr or 'unknown', username.lower())):
+            flash('Too many login attempts. Please try again later.', 'error')
+            return render_template('login.html'), 429
+        # Case-insensitive lookup backed by the lower(username) index
+        from sqlalchemy import func
+        user = User.query.filter(func.lower(User.username) == username.lower()).first()
+        
+        if user and _check_password_cached(user.password_hash, password):
+            login_user(user)
+            # Snapshot cheap authorization flags on the session so future
+            # admin gates don't need the user row at all
+            session['is_admin'] = bool(user.is_admin)
+            session['uid'] = user.id
+            return redirect(url_for('dashboard'))
+        else:
+            if user is None:
+                # Burn the same KDF cost as a real verify (timing side channel)
+                check_password_hash(_DUMMY_HASH, password)
+            flash('Invalid username or password', 'error')
+    
+    return render_template('login.html')
+
+@app.route('/logout')
+@login_required
+def logout():
+    session.pop('is_admin', None)
+    session.pop('uid', None)
+    logout_user()
+    return redirect(url_for('login'))
+
+@app.route('/settings', methods=['GET', 'POST'])
+@login_required
+def user_settings():
+    if request.method == 'POST':
+        # Handle theme change
+        theme = request.form.get('theme')
+        if theme in ['dark', 'light']:
+            current_user.theme = theme
+            flash('Appearance settings updated', 'success')
+            db.session.commit()
+            _invalidate_user_cache(current_user.id)
+            return redirect(url_for('user_settings'))
+        
+        # Handle account changes
+        new_username = request.form.get('username', '').strip()
+        current_password = request.form.get('current_password', '')
+        new_password = request.form.get('new_password', '')
+        confirm_password = request.form.get('confirm_password', '')
+
+        # Change username
+        if new_username and new_username != current_user.username:
+            # Existence probe only - no need to pull the whole row; compares
+            # case-insensitively to match the unique lower(username) index
+            from sqlalchemy import func
+            if db.session.query(db.exists().where(
+                    func.lower(User.username) == new_username.lower(),
+                    User.id != current_user.id)).scalar():
+                flash('Username already taken', 'error')
+                return redirect(url_for('user_settings'))
+            current_user.username = new_username
+            flash('Username updated', 'success')
+
+        # Change password
+        if new_password:
+            if not _check_password_cached(current_user.password_hash, current_password):
+                flash('Current password incorrect', 'error')
+                return redirect(url_for('user_settings'))
+            if new_password != confirm_password:
+                flash('New passwords do not match', 'error')
+                return redirect(url_for('user_settings'))
+            current_user.password_hash = _hash_password(new_password)
+            flash('Password updated', 'success')
+
+        db.session.commit()
+        _invalidate_user_cache(current_user.id)
+        return redirect(url_for('user_settings'))
+
+    return render_template('settings.html')
+
+import secrets
+
+# Reset codes are single-use and only honored for this long; the periodic
+# health check purges anything used or older so the table stays bounded
+_RESET_CODE_TTL = timedelta(hours=1)
+
+@app.route('/forgot-password', methods=['GET', 'POST'])
+def forgot_password():
+    if request.method == 'POST':
+        username = request.form.get('username', '').strip()
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            flash('If that user exists, a reset code has been generated (check logs).', 'info')
+            return redirect(url_for('forgot_password'))
+        # Invalidate previous unused codes for this user; marking them used
+        # (not deleting) keeps the audit trail, and skipping session
+        # synchronization keeps the UPDATE + INSERT in one flush/commit
+        PasswordResetCode.query.filter_by(user_id=user.id, used=False).update(
+            {'used': True}, synchronize_session=False)
+        code = secrets.token_hex(4)
+        prc = PasswordResetCode(user_id=user.id, code=code)
+        db.session.add(prc)
+        db.session.commit()
+        logger.warning(f'PASSWORD RESET CODE for user={user.username}: {code}')
+        flash('Reset code generated. Check server logs.', 'info')
+        return redirect(url_for('reset_password'))
+    return render_template('forgot_password.html')
+
+@app.route('/reset-password', methods=['GET', 'POST'])
+def reset_password():
+    if request.method == 'POST':
+        username = request.form.get('username', '').strip()
+        code = request.form.get('code', '').strip()
+        new_password = request.form.get('new_password', '')
+        confirm_password = request.form.get('confirm_password', '')
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            flash('Invalid code or user', 'error')
+            return redirect(url_for('reset_password'))
+        prc = PasswordResetCode.query.filter_by(user_id=user.id, code=code, used=False) \
+            .filter(PasswordResetCode.created_at > datetime.utcnow() - _RESET_CODE_TTL).first()
+        if not prc:
+            flash('Invalid, expired or already used code', 'error')
+            return redirect(url_for('reset_password'))
+        if new_password != confirm_password or not new_password:
+            flash('Passwords do not match or empty', 'error')
+            return redirect(url_for('reset_password'))
+        user.password_hash = _hash_password(new_password)
+        prc.used = True
+        db.session.commit()
+        _invalidate_user_cache(user.id)
+        flash('Password reset successful. You can now log in.', 'success')
+        return redirect(url_for('login'))
+    return render_template('reset_password.html')
+
+@app.route('/repositories')
+@login_required
+def repositories():
+    uid = current_user.id  # resolve the LocalProxy once per request
+    repos = get_user_repositories()
+
+    # One GROUP BY over the (user_id, status) index instead of four queries
+    # that hydrate every historical job row just to count it
+    from sqlalchemy import func, select
+    status_counts = dict(db.session.execute(
+        select(BackupJob.status, func.count())
+        .where(BackupJob.user_id == uid)
+        .group_by(BackupJob.status)
+    ).all())
+    # In-flight jobs are still loaded as rows - the template lists them - but
+    # they are bounded by the worker pool, unlike the completed/failed history
+    running_jobs = BackupJob.query.filter_by(user_id=uid, status='running').all()
+    pending_jobs = BackupJob.query.filter_by(user_id=uid, status='pending').all()
+
+    active_backups = len(running_jobs) + len(pending_jobs)
+
+    backup_status = {
+        'running': len(running_jobs),
+        'pending': len(pending_jobs),
+        'completed': status_counts.get('completed', 0),
+        'failed': status_counts.get('failed', 0),
+        'total_repos': len(repos),
+        'active': active_backups > 0,
+        'running_jobs': running_jobs,
+        'pending_jobs': pending_jobs
+    }
+    
+    return render_template('repositories.html', repositories=repos, backup_status=backup_status)
+
+import re
+
+# Valid interval ranges per custom-schedule unit, shared by add/edit
+_CUSTOM_RANGES = {'days': (1, 365), 'weeks': (1, 52), 'months': (1, 12)}
+_TIME_RE = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+
+def _validate_custom_schedule(form):
+    """Validate custom-schedule form fields.
+
+    Returns (interval, unit, hour, minute) or raises ValueError with a
+    user-facing message. Data-driven so add/edit share one code path.
+    """
+    unit = form.get('custom_unit', 'days')
+    lo, hi = _CUSTOM_RANGES.get(unit, _CUSTOM_RANGES['days'])
+    try:
+        interval = int(form.get('custom_interval', 1))
+    except ValueError:
+        raise ValueError(f'Custom interval for {unit} must be between {lo} and {hi}')
+    if not lo <= interval <= hi:
+        raise ValueError(f'Custom interval for {unit} must be between {lo} and {hi}')
+
+    match = _TIME_RE.match(form.get('custom_time', '02:00'))
+    if not match:
+        raise ValueError('Invalid time format. Please use HH:MM format')
+    return interval, unit, int(match.group(1)), int(match.group(2))
+
+@app.route('/repositories/add', methods=['GET', 'POST'])
+@login_required
+def add_repository():
+    if request.method == 'POST':
+        repo_url = request.form['repo_url']
+        github_token = request.form.get('github_token', '')
+        backup_format = request.form['backup_format']
+        schedule_type = request.form['schedule_type']
+        retention_count = int(request.form['retention_count'])
+        
+        # Handle custom schedule fields
+        custom_interval = None
+        custom_unit = None
+        custom_hour = 2
+        custom_minute = 0
+        
+        if schedule_type == 'custom':
+            try:
+                custom_interval, custom_unit, custom_hour, custom_minute = \
+                    _validate_custom_schedule(request.form)
+            except ValueError as e:
+                flash(str(e), 'error')
+                return render_template('add_repository.html')
+        
+        # Extract repo name from URL
+        repo_name = repo_url.split('/')[-1].replace('.git', '')
+        
+        repository = Repository(
+            user_id=current_user.id,
+            name=repo_name,
+            url=repo_url,
+            github_token=github_token,
+            backup_format=backup_format,
+            schedule_type=schedule_type,
+            retention_count=retention_count,
+            custom_interval=custom_interval,
+            custom_unit=custom_unit,
+            custom_hour=custom_hour,
+            custom_minute=custom_minute,
+            is_active=True
+        )
+        
+        db.session.add(repository)
+        db.session.commit()
+        _invalidate_page_cache(current_user.id)
+
+        # Schedule the backup job
+        schedule_backup_job(repository)
+        
+        flash('Repository added successfully', 'success')
+        return redirect(url_for('repositories'))
+    
+    return render_template('add_repository.html')
+
+@app.route('/repositories/add-by-username', methods=['GET', 'POST'])
+@login_required
+def add_repositories_by_username():
+    """Add all repositories from a GitHub user"""
+    if request.method == 'POST':
+        github_username = request.form.get('github_username', '').strip()
+        github_token = request.form.get('github_token', '').strip()
+        backup_format = request.form.get('backup_format', 'folder')
+        schedule_type = request.form.get('schedule_type', 'daily')
+        retention_count = int(request.form.get('retention_count', 5))
+        
+        if not github_username:
+            flash('Please provide a GitHub username', 'error')
+            return render_template('add_by_username.html')
+        
+        try:
+            from github import Github, GithubException
+            
+            # Initialize GitHub API
+            if github_token:
+                g = Github(github_token)
+            else:
+                g = Github()  # Unauthenticated (limited rate limit)
+            
+            # Fetch the user
+            try:
+                user = g.get_user(github_username)
+            except GithubException as e:
+                flash(f'GitHub user "{github_username}" not found or API error: {str(e)}', 'error')
+                logger.warning(f"Failed to fetch GitHub user {github_username}: {str(e)}")
+                return render_template('add_by_username.html')
+            
+            # Get all repositories
+            try:
+                repos = user.get_repos(type='all')  # all, public, private
+                repos_list = list(repos)
+            except GithubException as e:
+                flash(f'Error fetching repositories: {str(e)}', 'error')
+                logger.warning(f"Failed to fetch repos for {github_username}: {str(e)}")
+                return render_template('add_by_username.html')
+            
+            if not repos_list:
+                flash(f'No repositories found for user "{github_username}"', 'info')
+                return redirect(url_for('repositories'))
+            
+            added_count = 0
+            skipped_count = 0
+            failed_repos = []
+            
+            for repo in repos_list:
+                try:
+                    # Skip if repo is a fork (optional - change if you want to include forks)
+                    if repo.fork:
+                        logger.info(f"Skipping forked repository: {repo.name}")
+                        skipped_count += 1
+                        continue
+                    
+                    repo_name = repo.name
+                    repo_url = repo.clone_url  # Uses HTTPS URL
+                    
+                    # Check if this repository already exists for this user
+                    existing = Repository.query.filter_by(
+                        user_id=current_user.id,
+                        name=repo_name,
+                        url=repo_url
+                    ).first()
+                    
+                    if existing:
+                        logger.info(f"Repository {repo_name} already exists for user, skipping")
+                        skipped_count += 1
+                        continue
+                    
+                    # Create new repository record
+                    new_repo = Repository(
+                        user_id=current_user.id,
+                        name=repo_name,
+                        url=repo_url,
+                        github_token=github_token if repo.private else '',  # Only store token for private repos
+                        backup_format=backup_format,
+                        schedule_type=schedule_type,
+                        retention_count=retention_count,
+                        is_active=True
+                    )
+                    
+                    db.session.add(new_repo)
+                    added_count += 1
+                    logger.info(f"Added repository: {repo_name}")
+                    
+                except Exception as e:
+                    failed_repos.append((repo.name, str(e)))
+                    logger.error(f"Failed to add repository {repo.name}: {str(e)}")
+                    continue
+            
+            # Commit all new repositories
+            if added_count > 0:
+                try:
+                    db.session.commit()
+                    _invalidate_page_cache(current_user.id)
+                    logger.info(f"Committed {added_count} new repositories for user {current_user.id}")
+                    
+                    # Now schedule backup jobs for newly added repositories
+                    new_repos = Repository.query.filter_by(
+                        user_id=current_user.id,
+                        name=repo_name  # This will get the last one, but we'll schedule all active ones
+                    ).filter(Repository.schedule_type != 'manual').all()
+                    
+                    # Actually, let's schedule all added repos from this batch
+                    # Get repos added in last few seconds
+                    cutoff_time = datetime.utcnow() - timedelta(seconds=5)
+                    recently_added = Repository.query.filter_by(
+                        user_id=current_user.id,
+                        is_active=True
+                    ).filter(Repository.created_at > cutoff_time).all()
+                    
+                    for repo in recently_added:
+                        if repo.schedule_type != 'manual':
+                            try:
+                                schedule_backup_job(repo)
+                                logger.info(f"Scheduled backup for {repo.name}")
+                            except Exception as e:
+                                logger.error(f"Failed to schedule backup for {repo.name}: {e}")
+                    
+                except Exception as e:
+                    db.session.rollback()
+                    flash(f'Error saving repositories: {str(e)}', 'error')
+                    logger.error(f"Failed to commit repositories: {str(e)}")
+                    return render_template('add_by_username.html')
+            
+            # Build success message
+            message = f'Successfully added {added_count} repositories'
+            if skipped_count > 0:
+                message += f' ({skipped_count} skipped - already exist or are forks)'
+            if failed_repos:
+                message += f' ({len(failed_repos)} failed)'
+            
+            flash(message, 'success')
+            
+            if failed_repos:
+                logger.warning(f"Failed to add {len(failed_repos)} repositories: {failed_repos}")
+            
+            return redirect(url_for('repositories'))
+            
+        except Exception as e:
+            flash(f'Unexpected error: {str(e)}', 'error')
+            logger.error(f"Unexpected error in add_repositories_by_username: {str(e)}", exc_info=True)
+            return render_template('add_by_username.html')
+    
+    return render_template('add_by_username.html')
+
+@app.route('/repositories/<int:repo_id>/edit', methods=['GET', 'POST'])
+@login_required
+def edit_repository(repo_id):
+    def _rerender():
+        # Validation-error path only: load the row for the form re-render
+        repository = db.session.get(Repository, repo_id)
+        if repository is None or repository.user_id != current_user.id:
+            abort(404)
+        return render_template('edit_repository.html', repository=repository)
+
+    if request.method == 'POST':
+        values = {
+            'github_token': request.form.get('github_token', ''),
+            'backup_format': request.form['backup_format'],
+            'schedule_type': request.form['schedule_type'],
+            'retention_count': int(request.form['retention_count']),
+            'is_active': 'is_active' in request.form,
+        }
+
+        # Handle custom schedule fields
+        if values['schedule_type'] == 'custom':
+            try:
+                custom_interval, custom_unit, custom_hour, custom_minute = \
+                    _validate_custom_schedule(request.form)
+            except ValueError as e:
+                flash(str(e), 'error')
+                return _rerender()
+
+            values.update(custom_interval=custom_interval, custom_unit=custom_unit,
+                          custom_hour=custom_hour, custom_minute=custom_minute)
+        else:
+            # Reset custom fields when not using custom schedule
+            values.update(custom_interval=None, custom_unit=None, custom_hour=2, custom_minute=0)
+
+        # Single UPDATE ... RETURNING: one round-trip instead of load-then-write,
+        # and no TOCTOU window between the ownership check and the update
+        from sqlalchemy import select, update
+        stmt = (
+            update(Repository)
+            .where(Repository.id == repo_id, Repository.user_id == current_user.id)
+            .values(**values)
+            .returning(Repository)
+        )
+        orm_stmt = select(Repository).from_statement(stmt).execution_options(populate_existing=True)
+        repository = db.session.execute(orm_stmt).scalar_one_or_none()
+        if repository is None:
+            db.session.rollback()
+            abort(404)
+        db.session.commit()
+        _invalidate_page_cache(current_user.id)
+
+        # Reschedule the backup job - more robust approach
+        # replace_existing=True swaps the job atomically, so no remove/sleep
+        # dance; only drop the job when the schedule went away entirely
+        if repository.is_active and repository.schedule_type != 'manual':
+            schedule_backup_job(repository)
+            logger.info(f"Rescheduled job for repository: {repository.name}")
+        else:
+            job_id = f'backup_{repo_id}'
+            try:
+                if scheduler.get_job(job_id):
+                    scheduler.remove_job(job_id)
+                    logger.info(f"Removed job for now-unscheduled repository: {job_id}")
+            except JobLookupError:
+                # Raced with another removal; nothing left to do
+                pass
+
+
+        flash('Repository updated successfully', 'success')
+        return redirect(url_for('repositories'))
+
+    repository = db.session.get(Repository, repo_id)
+    if repository is None or repository.user_id != current_user.id:
+        abort(404)
+    return render_template('edit_repository.html', repository=repository)
+
+@app.route('/repositories/<int:repo_id>/delete', methods=['POST'])
+@login_required
+def delete_repository(repo_id):
+    repository = db.session.get(Repository, repo_id)
+    if repository is None or repository.user_id != current_user.id:
+        abort(404)
+    
+    # Remove scheduled job if one exists (probing first avoids building a
+    # JobLookupError in the common no-schedule case)
+    if scheduler.get_job(f'backup_{repo_id}') is not None:
+        try:
+            scheduler.remove_job(f'backup_{repo_id}')
+        except JobLookupError:
+            pass
+
+    db.session.delete(repository)
+    db.session.commit()
+    backup_service.discard_mirror(repo_id)
+    _invalidate_page_cache(current_user.id)
+
+    flash('Repository deleted successfully', 'success')
+    return redirect(url_for('repositories'))
+
+@app.route('/repositories/delete-all', methods=['POST'])
+@login_required
+def delete_all_repositories():
+    """Delete all repositories for the current user"""
+    repositories = Repository.query.filter_by(user_id=current_user.id).all()
+    
+    if not repositories:
+        flash('No repositories to delete', 'info')
+        return redirect(url_for('repositories'))
+    
+    deleted_count = 0
+    
+    for repository in repositories:
+        try:
+            # Remove scheduled job
+            if scheduler.get_job(f'backup_{repository.id}') is not None:
+                try:
+                    scheduler.remove_job(f'backup_{repository.id}')
+                    logger.info(f"Removed scheduled job for repository {repository.id}")
+                except JobLookupError:
+                    pass
+            
+            db.session.delete(repository)
+            backup_service.discard_mirror(repository.id)
+            deleted_count += 1
+            logger.info(f"Deleted repository: {repository.name}")
+        except Exception as e:
+            logger.error(f"Failed to delete repository {repository.id}: {str(e)}")
+            continue
+
+    if deleted_count > 0:
+        db.session.commit()
+        _invalidate_page_cache(current_user.id)
+        flash(f'Deleted {deleted_count} repository/repositories successfully', 'success')
+        logger.info(f"Deleted {deleted_count} repositories for user {current_user.id}")
+    else:
+        flash('Failed to delete repositories', 'error')
+    
+    return redirect(url_for('repositories'))
+
+def _run_backup_job(repo_id):
+    """Run a one-shot backup on the scheduler thread with its own app context"""
+    with app.app_context():
+        try:
+            repo = db.session.get(Repository, repo_id)
+            if not repo:
+                logger.warning(f"Repository {repo_id} not found, skipping manual backup")
+                return
+            backup_service.backup_repository(repo)
+            _invalidate_page_cache(repo.user_id)
+        except Exception as e:
+            logger.error(f"Manual backup failed for repository {repo_id}: {e}", exc_info=True)
+
+@app.route('/repositories/<int:repo_id>/backup', methods=['POST'])
+@login_required
+def manual_backup(repo_id):
+    repository = db.session.get(Repository, repo_id)
+    if repository is None or repository.user_id != current_user.id:
+        abort(404)
+
+    try:
+        # Hand the clone/compress work to the scheduler's executor so the
+        # HTTP response returns immediately instead of blocking for minutes.
+        # Pass the id, not the ORM object - the job re-fetches in its own session.
+        scheduler.add_job(
+            func=_run_backup_job,
+            trigger='date',
+            run_date=datetime.now(LOCAL_TZ),
+            args=[repository.id],
+            id=f'manual_{repo_id}_{int(time.time())}',
+            misfire_grace_time=3600
+        )
+        flash('Backup queued successfully', 'success')
+    except Exception as e:
+        logger.error(f"Failed to queue manual backup: {str(e)}")
+        flash('Backup failed to start. Check logs for details.', 'error')
+
+    return redirect(url_for('repositories'))
+
+@app.route('/repositories/backup-all', methods=['POST'])
+@login_required
+def backup_all_repositories():
+    """Trigger backups for all active repositories"""
+    repositories = Repository.query.filter_by(user_id=current_user.id, is_active=True).all()
+    
+    if not repositories:
+        flash('No active repositories to backup', 'info')
+        return redirect(url_for('repositories'))
+    
+    backup_count = 0
+    error_count = 0
+    
+    for repository in repositories:
+        try:
+            backup_service.backup_repository(repository)
+            backup_count += 1
+            logger.info(f"Triggered backup for repository: {repository.name}")
+        except Exception as e:
+            error_count += 1
+            logger.error(f"Failed to trigger backup for {repository.name}: {str(e)}")
+
+    _invalidate_page_cache(current_user.id)
+    if error_count == 0:
+        flash(f'Started backup for {backup_count} repositories', 'success')
+    else:
+        flash(f'Started backup for {backup_count} repositories ({error_count} failed)', 'warning')
+    
+    return redirect(url_for('repositories'))
+
+@app.route('/jobs')
+@login_required
+def backup_jobs():
+    # Paginate - the job history grows without bound, so never load it whole
+    uid = current_user.id  # resolve the LocalProxy once per request
+    page = request.args.get('page', 1, type=int)
+    cache_key = ('jobs', uid, page)
+    with _cache_lock:
+        pagination = _page_cache.get(cache_key)
+    if pagination is None:
+        pagination = BackupJob.query \
+            .filter_by(user_id=uid) \
+            .order_by(BackupJob.created_at.desc()) \
+            .paginate(page=page, per_page=50, error_out=False)
+        with _cache_lock:
+            _page_cache[cache_key] = pagination
+    jobs = pagination.items
+    # Indexed EXISTS probe - a running job may not be on the current page
+    has_running = db.session.query(
+        BackupJob.query.filter_by(user_id=uid, status='running').exists()
+    ).scalar()
+    return stream_template('backup_jobs.html', jobs=jobs, pagination=pagination, has_running=has_running)
+
+# Liveness probes hit these endpoints several times a second; cache the
+# serialized JSON briefly so each poll doesn't re-probe and re-serialize.
+# A stale-by-a-second answer is well within probe tolerances.
+_health_cache = (0.0, None, 200)       # (expires_monotonic, body, status)
+_sched_status_cache = (0.0, None)
+
+@app.route('/health')
+def health_check():
+    global _health_cache
+    expires, body, status = _health_cache
+    if body is None or time.monotonic() >= expires:
+        # DB connectivity is probed here on demand instead of at worker boot,
+        # so this doubles as a real readiness check for Docker/Kubernetes
+        try:
+            db.session.execute(text('SELECT 1'))
+            db_ok = True
+        except Exception as e:
+            logger.error(f'Health check DB probe failed: {e}')
+            db_ok = False
+        # One clock read instead of two; probes hit this endpoint constantly
+        utc_time = datetime.now(dt_timezone.utc)
+        local_time = utc_time.astimezone(LOCAL_TZ)
+        body = json.dumps({
+            'status': 'healthy' if db_ok else 'degraded',
+            'db': db_ok,
+            'utc_time': utc_time.isoformat(),
+            'local_time': local_time.isoformat(),
+            'timezone': str(LOCAL_TZ),
+            'timezone_name': local_time.tzname() or _LOCAL_TZ_FALLBACK_NAME
+        })
+        status = 200 if db_ok else 503
+        _health_cache = (time.monotonic() + 1.0, body, status)
+    return app.response_class(body, status=status, mimetype='application/json')
+
+@app.route('/api/scheduler/status')
+@login_required
+def scheduler_status():
+    """Debug endpoint to check scheduled jobs"""
+    global _sched_status_cache
+    expires, body = _sched_status_cache
+    if body is None or time.monotonic() >= expires:
+        jobs = []
+        for job in scheduler.get_jobs():
+            jobs.append({
+                'id': job.id,
+                'name': job.name,
+                'next_run': job.next_run_time.isoformat() if job.next_run_time else None,
+                'trigger': str(job.trigger)
+            })
+        body = json.dumps({
+            'scheduler_running': scheduler.running,
+            'scheduled_jobs': jobs,
+            'total_jobs': len(jobs)
+        })
+        _sched_status_cache = (time.monotonic() + 2.0, body)
+    return app.response_class(body, mimetype='application/json')
+
+@app.route('/api/test-backup/<int:repo_id>', methods=['POST'])
+@login_required
+def test_scheduled_backup(repo_id):
+    """Test endpoint to simulate a scheduled backup (for debugging)"""
+    repository = db.session.get(Repository, repo_id)
+    if repository is None or repository.user_id != current_user.id:
+        abort(404)
+
+    # The request already runs inside an app context, so no wrapper closure
+    # is needed - closures here only pinned stale ORM objects
+    try:
+        if repository.is_active:
+            backup_service.backup_repository(repository)
+            _invalidate_page_cache(current_user.id)
+            return jsonify({'success': True, 'message': 'Backup completed successfully'})
+        return jsonify({'success': True, 'message': f'Repository {repo_id} is inactive'})
+    except Exception as e:
+        logger.error(f"Error in /api/test-backup endpoint for repository {repo_id}: {e}", exc_info=True)
+        return jsonify({'success': False, 'error': 'An internal error occurred.'}), 500
+
+@app.route('/api/theme', methods=['POST'])
+@login_required
+def update_theme():
+    data = request.get_json()
+    theme = data.get('theme')
+    
+    if theme in ['dark', 'light']:
+        current_user.theme = theme
+        db.session.commit()
+        _invalidate_user_cache(current_user.id)
+        return jsonify({'success': True, 'theme': theme})
+    
+    return jsonify({'success': False, 'error': 'Invalid theme'}), 400
+
+@app.route('/favicon.ico')
+def favicon():
+    resp = send_from_directory(os.path.join(app.root_path, 'static', 'img'), 'ghbackup_ico.ico', mimetype='image/vnd.microsoft.icon')
+    # The icon only changes between deploys; let browsers stop re-requesting it
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+def _scheduled_backup(repo_id):
+    """Run one scheduled backup for a repository.
+
+    Module-level (not a closure) and keyed by the plain integer id so the
+    persistent job store can pickle the job and restore it after restart.
+    """
+    with app.app_context():
+        try:
+            # Narrow probe first: ticks that end up skipped (inactive,
+            # duplicate, already running) never hydrate the full row with
+            # its token/URL/schedule columns
+            from sqlalchemy import or_, select
+            probe = db.session.execute(
+                select(Repository.is_active, Repository.name)
+                .where(Repository.id == repo_id)
+            ).first()
+            if probe is None or not probe.is_active:
+                logger.warning(f"Repository {repo_id} not found or inactive, skipping backup")
+                return
+            repo_name = probe.name
+
+            # Multiple layers of duplicate prevention
+            
+            # 0. Auto-cleanup: Mark any long-running jobs as failed (bulk)
+            stuck_cutoff = datetime.utcnow() - timedelta(hours=2)
+            with _db_write_lock:
+                stuck_count = BackupJob.query.filter_by(
+                    repository_id=repo_id,
+                    status='running'
+                ).filter(
+                    BackupJob.started_at < stuck_cutoff
+                ).update({
+                    'status': 'failed',
+                    'error_message': 'Job stuck for over 2 hours, automatically failed',
+                    'completed_at': datetime.utcnow(),
+                }, synchronize_session=False)
+                db.session.commit()
+            if stuck_count:
+                logger.warning(f"Cleaned up {stuck_count} stuck running jobs for repository {repo_name}")
+            
+            # 1+2. One query answers both "already running?" and "started
+            # within the last 2 minutes?" instead of two separate probes
+            recent_cutoff = datetime.utcnow() - timedelta(minutes=2)
+            blocker = db.session.execute(
+                select(BackupJob.id, BackupJob.status, BackupJob.started_at)
+                .where(BackupJob.repository_id == repo_id)
+                .where(or_(BackupJob.status == 'running',
+                           BackupJob.started_at > recent_cutoff))
+                .limit(1)
+            ).first()
+
+            if blocker is not None:
+                if blocker.status == 'running':
+                    logger.warning(f"Backup already running for repository {repo_name} (job {blocker.id}), skipping")
+                else:
+                    logger.warning(f"Recent backup found for repository {repo_name} (started at {blocker.started_at}), skipping to prevent duplicates")
+                return
+
+
+            # 3. Per-repo in-process lock instead of an fcntl tempfile dance:
+            # the scheduler runs in one process (leadership lock), so a
+            # threading.Lock covers the same race without the open/flock/
+            # unlink syscalls per tick. The running-job DB check above stays
+            # as the cross-process guard.
+            lock = _repo_backup_locks.setdefault(repo_id, threading.Lock())
+            if not lock.acquire(blocking=False):
+                logger.warning(f"Backup already in progress in this process for repository {repo_name}, skipping")
+                return
+            try:
+                # Only now, with the backup actually going ahead, fetch the
+                # full row the backup service needs
+                repo = db.session.get(Repository, repo_id)
+                if repo is None:
+                    return
+                logger.info(f"Starting scheduled backup for repository: {repo_name}")
+                backup_service.backup_repository(repo)
+                _invalidate_page_cache(repo.user_id)
+                logger.info(f"Completed scheduled backup for repository: {repo_name}")
+            finally:
+                lock.release()
+
+        except Exception as e:
+            logger.error(f"Error in scheduled backup for repository {repo_id}: {e}", exc_info=True)
+
+def schedule_backup_job(repository):
+    """Schedule (or reschedule) the backup job for a repository.
+
+    The persistent job store keys jobs by id, so replace_existing=True is the
+    whole dedupe story - no tracking set or remove-then-add dance needed.
+    """
+    if not repository.is_active:
+        logger.info(f"Repository {repository.name} is inactive, not scheduling")
+        return
+
+    job_id = f'backup_{repository.id}'
+
+    # Create new schedule based on schedule_type
+    if repository.schedule_type in _TRIGGERS:
+        trigger = _TRIGGERS[repository.schedule_type]
+    elif repository.schedule_type == 'custom':
+        trigger = _custom_trigger(
+            repository.custom_hour or 2,
+            repository.custom_minute or 0,
+            repository.custom_interval or 1,
+            repository.custom_unit or 'days',
+            int(time.time() // 3600),
+        )
+        if trigger is None:
+            return  # Invalid unit
+    else:
+        return  # Manual only
+    
+    scheduler.add_job(
+        func=_scheduled_backup,
+        args=[repository.id],
+        trigger=trigger,
+        id=job_id,
+        name=f'Backup {repository.name}',
+        replace_existing=True,
+        misfire_grace_time=60,  # Reduced from 5 minutes to 1 minute
+        coalesce=True,  # Combine multiple pending executions
+        max_instances=1  # Only one instance of this specific job can run
+    )
+    
+    logger.info(f"Successfully scheduled backup job for {repository.name} with trigger: {trigger}")
+
+# Cross-worker scheduler leadership. Under gunicorn -w N every worker imports
+# this module; without a guard each one would start a scheduler and fire every
+# backup N times. Only the worker holding the lock file actually runs jobs.
+import fcntl
+_scheduler_lock_handle = None
+
+def _acquire_scheduler_leadership():
+    """Try to become the single job-firing scheduler process on this host"""
+    global _scheduler_lock_handle
+    lock_path = os.environ.get('SCHEDULER_LOCK_FILE', '/app/data/.scheduler.lock')
+    try:
+        handle = open(lock_path, 'w')
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        logger.info(f"Scheduler leadership not acquired ({e}); another worker runs the jobs")
+        return False
+    # Keep the handle open for the process lifetime so the lock is held
+    _scheduler_lock_handle = handle
+    return True
+
+# Initialize scheduler with existing repositories at startup
+# This runs after all functions are defined so that jobs restored from the
+# persistent store can resolve their callables
+if not globals().get('_scheduler_startup_completed', False):
+    try:
+        if _acquire_scheduler_leadership():
+            scheduler.start()
+        else:
+            # Start paused: this worker can still write schedule changes into
+            # the shared job store, but never fires jobs itself
+            scheduler.start(paused=True)
+        atexit.register(lambda: scheduler.shutdown())
+        with app.app_context():
+            logger.info("Starting scheduler initialization at app startup...")
+            
+            # Log current scheduler state
+            existing_jobs = scheduler.get_jobs()
+            logger.info(f"Scheduler has {len(existing_jobs)} existing jobs before initialization")
+
+            # Only the leader rescans/cleans the job table; paused workers
+            # would race it and duplicate the work
+            if _scheduler_lock_handle is not None:
+                ensure_scheduler_initialized()
+            
+            # Log final state
+            final_jobs = scheduler.get_jobs()
+            backup_jobs = [job for job in final_jobs if job.id.startswith('backup_')]
+            logger.info(f"Scheduler initialization completed. Total jobs: {len(final_jobs)}, Backup jobs: {len(backup_jobs)}")
+            
+            for job in backup_jobs:
+                logger.info(f"Scheduled job: {job.id} -> next run: {job.next_run_time}")
+            
+            globals()['_scheduler_startup_completed'] = True
+            
+    except Exception as e:
+        logger.error(f"Failed to initialize scheduler at startup: {e}")
+        import traceback
+        logger.error(f"Traceback: {traceback.format_exc()}")
+else:
+    logger.info("Scheduler startup initialization skipped - already completed")
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=8080, debug=False)
@@ -1,411 +1,825 @@
-import os
-import git
-import shutil
-import zipfile
-import tarfile
-import logging
-from datetime import datetime, timedelta
-from pathlib import Path
-from github import Github
-from models import db, BackupJob
-from urllib.parse import urlparse
-
-logger = logging.getLogger(__name__)
-
-class BackupService:
-    def __init__(self):
-        self.backup_base_dir = Path('/app/backups')
-        self.backup_base_dir.mkdir(exist_ok=True)
-    
-    def _extract_github_username(self, repo_url):
-        """Extract GitHub username from repository URL
-        
-        Handles both formats:
-        - https://github.com/username/repo
-        - git@github.com:username/repo.git
-        """
-        try:
-            # Parse the URL
-            if repo_url.startswith('git@'):
-                # git@github.com:username/repo.git
-                parts = repo_url.split(':')[1].split('/')
-                username = parts[0]
-            else:
-                # https://github.com/username/repo
-                parts = repo_url.rstrip('/').split('/')
-                username = parts[-2]  # Second to last part
-            
-            return username.strip()
-        except (IndexError, AttributeError):
-            logger.warning(f"Could not extract username from URL: {repo_url}, using 'unknown'")
-            return 'unknown'
-    
-    def backup_repository(self, repository):
-        """Backup a repository according to its settings"""
-        logger.info(f"Starting backup for repository: {repository.name}")
-        
-        # Check if there's already a running backup for this repository
-        existing_running_job = BackupJob.query.filter_by(
-            repository_id=repository.id,
-            status='running'
-        ).first()
-        
-        if existing_running_job:
-            logger.warning(f"Backup already running for repository {repository.name} (job {existing_running_job.id}), skipping")
-            return
-        
-        # Also check for very recent backups (within last 30 seconds) to prevent rapid duplicates
-        recent_cutoff = datetime.utcnow() - timedelta(seconds=30)
-        recent_job = BackupJob.query.filter_by(
-            repository_id=repository.id
-        ).filter(
-            BackupJob.started_at > recent_cutoff
-        ).first()
-        
-        if recent_job:
-            logger.warning(f"Very recent backup found for repository {repository.name} (started at {recent_job.started_at}), skipping to prevent duplicates")
-            return
-        
-        # Auto-cleanup: Check for and clean up any orphaned temp directories
-        github_username = self._extract_github_username(repository.url)
-        user_backup_dir = self.backup_base_dir / github_username
-        repo_backup_dir = user_backup_dir / repository.name
-        if repo_backup_dir.exists():
-            self._cleanup_temp_directories(repo_backup_dir)
-        
-        # Create backup job record
-        backup_job = BackupJob(
-            user_id=repository.user_id,
-            repository_id=repository.id,
-            status='running',
-            started_at=datetime.utcnow()
-        )
-        db.session.add(backup_job)
-        
-        # Commit immediately to make this job visible to other processes/threads
-        try:
-            db.session.commit()
-            logger.info(f"Created backup job {backup_job.id} for repository {repository.name}")
-        except Exception as e:
-            logger.error(f"Failed to commit backup job creation: {e}")
-            db.session.rollback()
-            return
-        
-        temp_clone_dir = None
-        try:
-            # Extract GitHub username from repository URL
-            github_username = self._extract_github_username(repository.url)
-            
-            # Create GitHub-username-specific backup directory
-            user_backup_dir = self.backup_base_dir / github_username
-            user_backup_dir.mkdir(exist_ok=True)
-            
-            # Create repository-specific backup directory
-            repo_backup_dir = user_backup_dir / repository.name
-            repo_backup_dir.mkdir(exist_ok=True)
-            
-            # Generate timestamp for this backup with microseconds for uniqueness
-            timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S_%f')
-            backup_name = f"{repository.name}_{timestamp[:19]}"  # Keep readable format for backup name
-            
-            # Create unique temporary directory and ensure it's clean
-            temp_clone_dir = repo_backup_dir / f"temp_{timestamp}"
-            
-            # Ensure temp directory doesn't exist and create it
-            retry_count = 0
-            max_retries = 5
-            while temp_clone_dir.exists() and retry_count < max_retries:
-                logger.warning(f"Temp directory already exists, removing: {temp_clone_dir}")
-                try:
-                    shutil.rmtree(temp_clone_dir)
-                    break
-                except (OSError, PermissionError) as e:
-                    retry_count += 1
-                    if retry_count >= max_retries:
-                        raise Exception(f"Unable to clean temp directory after {max_retries} attempts: {e}")
-                    # Add a small delay and try with a new timestamp
-                    import time
-                    time.sleep(0.1)
-                    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S_%f')
-                    temp_clone_dir = repo_backup_dir / f"temp_{timestamp}"
-            
-            temp_clone_dir.mkdir(parents=True, exist_ok=False)
-            
-            self._clone_repository(repository, temp_clone_dir)
-            
-            # Create backup in specified format
-            backup_path = self._create_backup(
-                temp_clone_dir, 
-                repo_backup_dir, 
-                backup_name, 
-                repository.backup_format
-            )
-            
-            # Clean up old backups based on retention policy
-            self._cleanup_old_backups(repo_backup_dir, repository.retention_count, repository.backup_format)
-            
-            # Update backup job record
-            backup_job.status = 'completed'
-            backup_job.backup_path = str(backup_path)
-            backup_job.file_size = self._get_file_size(backup_path)
-            backup_job.completed_at = datetime.utcnow()
-            
-            # Update repository last backup time
-            repository.last_backup = datetime.utcnow()
-            
-            logger.info(f"Backup completed successfully: {backup_path}")
-        
-        except Exception as e:
-            logger.error(f"Backup failed for repository {repository.name}: {str(e)}")
-            backup_job.status = 'failed'
-            backup_job.error_message = str(e)
-            backup_job.completed_at = datetime.utcnow()
-            
-            # Ensure we commit the failed status immediately
-            try:
-                db.session.commit()
-            except Exception as commit_error:
-                logger.error(f"Failed to commit backup job failure status: {commit_error}")
-        
-        finally:
-            # Always clean up temporary directory
-            if temp_clone_dir and temp_clone_dir.exists():
-                try:
-                    logger.info(f"Cleaning up temporary directory: {temp_clone_dir}")
-                    shutil.rmtree(temp_clone_dir)
-                except Exception as cleanup_error:
-                    logger.error(f"Failed to cleanup temp directory {temp_clone_dir}: {cleanup_error}")
-                    # Try force cleanup
-                    try:
-                        import stat
-                        def handle_remove_readonly(func, path, exc):
-                            if exc[1].errno == 13:  # Permission denied
-                                os.chmod(path, stat.S_IWRITE)
-                                func(path)
-                            else:
-                                raise
-                        shutil.rmtree(temp_clone_dir, onerror=handle_remove_readonly)
-                        logger.info(f"Force cleaned temp directory: {temp_clone_dir}")
-                    except Exception as force_error:
-                        logger.error(f"Could not force clean temp directory: {force_error}")
-            
-            # Final commit to ensure all changes are saved
-            try:
-                db.session.commit()
-            except Exception as final_commit_error:
-                logger.error(f"Failed final commit for backup job: {final_commit_error}")
-                # Try to rollback to prevent session issues
-                try:
-                    db.session.rollback()
-                except:
-                    pass
-    
-    def _clone_repository(self, repository, clone_dir):
-        """Clone a repository to the specified directory"""
-        clone_url = repository.url
-        
-        # If it's a private repository and we have a token, modify the URL
-        if repository.github_token and repository.github_token.strip():
-            if clone_url.startswith('https://github.com/'):
-                # Convert https://github.com/user/repo to https://token@github.com/user/repo
-                clone_url = clone_url.replace('https://github.com/', f'https://{repository.github_token}@github.com/')
-        
-        # Clean up any existing temp directories for this repository first
-        self._cleanup_temp_directories(clone_dir.parent)
-        
-        # Ensure the clone directory is completely clean before starting
-        if clone_dir.exists():
-            logger.warning(f"Clone directory exists before cloning, removing: {clone_dir}")
-            try:
-                shutil.rmtree(clone_dir)
-            except Exception as e:
-                logger.error(f"Failed to remove existing clone directory: {e}")
-                raise Exception(f"Cannot clean clone directory: {e}")
-        
-        # Recreate the directory to ensure it's empty
-        clone_dir.mkdir(parents=True, exist_ok=False)
-        
-        # Clone the repository with error handling
-        try:
-            # Use git command directly for better error handling
-            import subprocess
-            git_cmd = [
-                'git', 'clone', 
-                '--depth=1', 
-                '--verbose',
-                '--config', 'core.autocrlf=false',  # Prevent line ending issues
-                '--config', 'core.filemode=false',  # Prevent permission issues
-                clone_url, 
-                str(clone_dir)
-            ]
-            
-            result = subprocess.run(
-                git_cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=300,  # 5 minute timeout
-                cwd=str(clone_dir.parent)
-            )
-            
-            if result.returncode != 0:
-                error_msg = f"Git clone failed with exit code {result.returncode}\n"
-                error_msg += f"stdout: {result.stdout}\n"
-                error_msg += f"stderr: {result.stderr}"
-                logger.error(error_msg)
-                raise Exception(f"Git clone failed: {result.stderr}")
-            
-            logger.info(f"Repository cloned successfully to: {clone_dir}")
-            
-        except subprocess.TimeoutExpired:
-            logger.error(f"Git clone timed out for repository: {repository.url}")
-            raise Exception("Git clone operation timed out")
-        except Exception as e:
-            logger.error(f"Git clone failed for {repository.url}: {str(e)}")
-            # Clean up on failure
-            if clone_dir.exists():
-                try:
-                    shutil.rmtree(clone_dir)
-                except:
-                    pass
-            raise e
-    
-    def _cleanup_temp_directories(self, repo_backup_dir):
-        """Clean up old temporary directories that might be left behind"""
-        try:
-            if not repo_backup_dir.exists():
-                return
-                
-            temp_dirs = [d for d in repo_backup_dir.iterdir() if d.is_dir() and d.name.startswith('temp_')]
-            current_time = datetime.utcnow().timestamp()
-            
-            for temp_dir in temp_dirs:
-                try:
-                    # Remove temp directories older than 10 minutes or any that exist from failed jobs
-                    dir_age = current_time - temp_dir.stat().st_mtime
-                    if dir_age > 600:  # 10 minutes
-                        logger.info(f"Cleaning up old temp directory: {temp_dir}")
-                        shutil.rmtree(temp_dir)
-                    elif not any(temp_dir.iterdir()):  # Empty directory
-                        logger.info(f"Cleaning up empty temp directory: {temp_dir}")
-                        shutil.rmtree(temp_dir)
-                except (OSError, PermissionError) as e:
-                    logger.warning(f"Failed to remove temp directory {temp_dir}: {e}")
-                    # Try to force remove if it's a permission issue
-                    try:
-                        import stat
-                        def handle_remove_readonly(func, path, exc):
-                            if exc[1].errno == 13:  # Permission denied
-                                os.chmod(path, stat.S_IWRITE)
-                                func(path)
-                            else:
-                                raise
-                        shutil.rmtree(temp_dir, onerror=handle_remove_readonly)
-                        logger.info(f"Force removed temp directory: {temp_dir}")
-                    except Exception as force_error:
-                        logger.error(f"Could not force remove temp directory {temp_dir}: {force_error}")
-                        
-        except Exception as e:
-            logger.warning(f"Failed to cleanup temp directories: {e}")
-    
-    def _create_backup(self, source_dir, backup_dir, backup_name, backup_format):
-        """Create backup in the specified format"""
-        if backup_format == 'folder':
-            # Just copy the folder structure
-            backup_path = backup_dir / backup_name
-            shutil.copytree(source_dir, backup_path, ignore=shutil.ignore_patterns('.git'))
-            return backup_path
-            
-        elif backup_format == 'zip':
-            backup_path = backup_dir / f"{backup_name}.zip"
-            with zipfile.ZipFile(backup_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zipf:
-                for root, dirs, files in os.walk(source_dir):
-                    # Skip .git directory
-                    if '.git' in dirs:
-                        dirs.remove('.git')
-                    
-                    for file in files:
-                        file_path = Path(root) / file
-                        arcname = file_path.relative_to(source_dir)
-                        zipf.write(file_path, arcname)
-            return backup_path
-            
-        elif backup_format == 'tar.gz':
-            backup_path = backup_dir / f"{backup_name}.tar.gz"
-            with tarfile.open(backup_path, 'w:gz') as tarf:
-                for root, dirs, files in os.walk(source_dir):
-                    # Skip .git directory
-                    if '.git' in dirs:
-                        dirs.remove('.git')
-                    
-                    for file in files:
-                        file_path = Path(root) / file
-                        arcname = file_path.relative_to(source_dir)
-                        tarf.add(file_path, arcname)
-            return backup_path
-        
-        else:
-            raise ValueError(f"Unsupported backup format: {backup_format}")
-    
-    def _cleanup_old_backups(self, backup_dir, retention_count, backup_format):
-        """Remove old backups beyond retention count"""
-        if backup_format == 'folder':
-            pattern = '*'
-            backups = [d for d in backup_dir.iterdir() if d.is_dir() and not d.name.startswith('temp_')]
-        elif backup_format == 'zip':
-            pattern = '*.zip'
-            backups = list(backup_dir.glob(pattern))
-        elif backup_format == 'tar.gz':
-            pattern = '*.tar.gz'
-            backups = list(backup_dir.glob(pattern))
-        else:
-            return
-        
-        # Sort by modification time (newest first)
-        backups.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-        
-        # Remove backups beyond retention count
-        for backup_to_remove in backups[retention_count:]:
-            try:
-                if backup_to_remove.is_dir():
-                    shutil.rmtree(backup_to_remove)
-                else:
-                    backup_to_remove.unlink()
-                logger.info(f"Removed old backup: {backup_to_remove}")
-            except Exception as e:
-                logger.error(f"Failed to remove old backup {backup_to_remove}: {str(e)}")
-    
-    def _get_file_size(self, path):
-        """Get file or directory size in bytes"""
-        path = Path(path)
-        if path.is_file():
-            return path.stat().st_size
-        elif path.is_dir():
-            return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
-        return 0
-    
-    def verify_github_access(self, repo_url, github_token=None):
-        """Verify if we can access a GitHub repository"""
-        try:
-            # Parse the URL and check the hostname
-            parsed = urlparse(repo_url)
-            if parsed.hostname and parsed.hostname.lower() == "github.com":
-                # Path is of the form /owner/repo(.git)? or /owner/repo/
-                path_parts = parsed.path.strip("/").split("/")
-                if len(path_parts) >= 2:
-                    owner = path_parts[0]
-                    repo_name = path_parts[1]
-                    if repo_name.endswith('.git'):
-                        repo_name = repo_name[:-4]
-
-                    if github_token:
-                        g = Github(github_token)
-                    else:
-                        g = Github()  # Anonymous access for public repos
-
-                    repo = g.get_repo(f"{owner}/{repo_name}")
-                    return True, f"Repository access verified: {repo.full_name}"
-
-            return False, "Invalid GitHub repository URL"
-
-        except Exception as e:
-            return False, f"Repository access failed: {str(e)}"
+import hashlib
+import os
+import stat
+import subprocess
+import time
+import git
+import shutil
+import zipfile
+import tarfile
+import threading
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+import requests
+import zstandard
+from models import db, BackupJob
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+def _link_or_copy(src, dst):
+    """copytree copy_function: hard-link when possible, else a real copy.
+
+    Linking is safe here because the source is an ephemeral clone that gets
+    deleted right after - the backup keeps the only remaining reference.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _handle_remove_readonly(func, path, exc):
+    """rmtree onerror hook: make permission-denied paths writable and retry"""
+    if exc[1].errno == 13:  # Permission denied
+        os.chmod(path, stat.S_IWRITE)
+        func(path)
+    else:
+        raise
+
+# Shared session for GitHub API probes: connection pooling reuses the TLS
+# handshake across verifications instead of paying it per call
+_http = requests.Session()
+
+# pigz compresses gzip streams on all cores; gzip itself is usually the
+# archival bottleneck, so use it whenever it's on PATH
+_PIGZ = shutil.which('pigz')
+
+# DEFLATE level for every archive path (git archive, pigz, zipfile,
+# tarfile). Low levels are several times faster on source trees for a
+# small ratio loss, so hosts that archive large repos can dial this down
+_COMPRESSION_LEVEL = int(os.environ.get('BACKUP_COMPRESSION_LEVEL', '6'))
+
+# zstd level for tar.zst backups; 1-5 is the real-time tier, and zstd-mt
+# spreads the work across cores regardless of level
+_ZSTD_LEVEL = int(os.environ.get('BACKUP_ZSTD_LEVEL', '3'))
+
+# Extensions whose content is already compressed - deflating them burns
+# CPU for essentially no size reduction, so store them as-is in zips
+_INCOMPRESSIBLE = {
+    '.png', '.jpg', '.jpeg', '.gif', '.mp4', '.mov', '.webm',
+    '.zip', '.gz', '.xz', '.7z', '.pdf', '.woff2',
+}
+
+class BackupService:
+    def __init__(self):
+        self.backup_base_dir = Path('/app/backups')
+        self.backup_base_dir.mkdir(exist_ok=True)
+    
+    def _extract_github_username(self, repo_url):
+        """Extract GitHub username from repository URL
+        
+        Handles both formats:
+        - https://github.com/username/repo
+        - git@github.com:username/repo.git
+        """
+        try:
+            # Parse the URL
+            if repo_url.startswith('git@'):
+                # git@github.com:username/repo.git
+                parts = repo_url.split(':')[1].split('/')
+                username = parts[0]
+            else:
+                # https://github.com/username/repo
+                parts = repo_url.rstrip('/').split('/')
+                username = parts[-2]  # Second to last part
+            
+            return username.strip()
+        except (IndexError, AttributeError):
+            logger.warning(f"Could not extract username from URL: {repo_url}, using 'unknown'")
+            return 'unknown'
+    
+    def backup_repository(self, repository):
+        """Backup a repository according to its settings"""
+        logger.info(f"Starting backup for repository: {repository.name}")
+
+        # One clock read for the whole setup phase
+        now = datetime.utcnow()
+
+        # Check if there's already a running backup for this repository
+        existing_running_job = BackupJob.query.filter_by(
+            repository_id=repository.id,
+            status='running'
+        ).first()
+
+        if existing_running_job:
+            logger.warning(f"Backup already running for repository {repository.name} (job {existing_running_job.id}), skipping")
+            return
+
+        # Also check for very recent backups (within last 30 seconds) to prevent rapid duplicates
+        recent_cutoff = now - timedelta(seconds=30)
+        recent_job = BackupJob.query.filter_by(
+            repository_id=repository.id
+        ).filter(
+            BackupJob.started_at > recent_cutoff
+        ).first()
+        
+        if recent_job:
+            logger.warning(f"Very recent backup found for repository {repository.name} (started at {recent_job.started_at}), skipping to prevent duplicates")
+            return
+        
+        # Auto-cleanup: Check for and clean up any orphaned temp directories
+        github_username = self._extract_github_username(repository.url)
+        user_backup_dir = self.backup_base_dir / github_username
+        repo_backup_dir = user_backup_dir / repository.name
+        if repo_backup_dir.exists():
+            self._sweep_orphans_once(repo_backup_dir)
+        
+        # Create backup job record
+        backup_job = BackupJob(
+            user_id=repository.user_id,
+            repository_id=repository.id,
+            status='running',
+            started_at=now
+        )
+        db.session.add(backup_job)
+        
+        # Commit immediately to make this job visible to other processes/threads
+        try:
+            db.session.commit()
+            logger.info(f"Created backup job {backup_job.id} for repository {repository.name}")
+        except Exception as e:
+            logger.error(f"Failed to commit backup job creation: {e}")
+            db.session.rollback()
+            return
+        
+        temp_clone_dir = None
+        try:
+            # Extract GitHub username from repository URL
+            github_username = self._extract_github_username(repository.url)
+            
+            # Create GitHub-username-specific backup directory
+            user_backup_dir = self.backup_base_dir / github_username
+            user_backup_dir.mkdir(exist_ok=True)
+            
+            # Create repository-specific backup directory
+            repo_backup_dir = user_backup_dir / repository.name
+            repo_backup_dir.mkdir(exist_ok=True)
+            
+            # Generate timestamp for this backup with microseconds for uniqueness
+            timestamp = now.strftime('%Y%m%d_%H%M%S_%f')
+            backup_name = f"{repository.name}_{timestamp[:19]}"  # Keep readable format for backup name
+            
+            # Bring the persistent mirror up to date - repeat runs transfer
+            # only objects new since the previous backup
+            mirror_path = self._update_mirror(repository)
+
+            if repository.backup_format in ('zip', 'tar.gz', 'tar.zst'):
+                # Archives stream straight from the mirror's pack data -
+                # no temp clone, no working tree
+                backup_path = self._create_backup(
+                    mirror_path,
+                    repo_backup_dir,
+                    backup_name,
+                    repository.backup_format
+                )
+            else:
+                # folder format needs a working tree: check one out from the
+                # local mirror (no network, objects shared via hardlinks)
+                scratch_dir = self._scratch_dir(repo_backup_dir, repository.name)
+                if scratch_dir != repo_backup_dir:
+                    self._sweep_orphans_once(scratch_dir)
+                temp_clone_dir = scratch_dir / f"temp_{timestamp}"
+
+                # Ensure temp directory doesn't exist and create it
+                retry_count = 0
+                max_retries = 5
+                while temp_clone_dir.exists() and retry_count < max_retries:
+                    logger.warning(f"Temp directory already exists, removing: {temp_clone_dir}")
+                    try:
+                        shutil.rmtree(temp_clone_dir)
+                        break
+                    except (OSError, PermissionError) as e:
+                        retry_count += 1
+                        if retry_count >= max_retries:
+                            raise Exception(f"Unable to clean temp directory after {max_retries} attempts: {e}")
+                        # Add a small delay and try with a new timestamp
+                        time.sleep(0.1)
+                        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S_%f')
+                        temp_clone_dir = scratch_dir / f"temp_{timestamp}"
+
+                temp_clone_dir.mkdir(parents=True, exist_ok=False)
+
+                self._clone_repository(repository, temp_clone_dir, source=str(mirror_path))
+
+                backup_path = self._create_backup(
+                    temp_clone_dir,
+                    repo_backup_dir,
+                    backup_name,
+                    repository.backup_format
+                )
+
+                # Unchanged files share storage with the previous backup
+                self._dedup_against_previous(repo_backup_dir, backup_path)
+            
+            # Clean up old backups based on retention policy
+            self._cleanup_old_backups(repo_backup_dir, repository.retention_count, repository.backup_format)
+            
+            # Update backup job record and the repository's last backup
+            # time from the same clock read
+            finished_at = datetime.utcnow()
+            backup_job.status = 'completed'
+            backup_job.backup_path = str(backup_path)
+            backup_job.file_size = self._get_file_size(backup_path)
+            backup_job.completed_at = finished_at
+            repository.last_backup = finished_at
+            
+            logger.info(f"Backup completed successfully: {backup_path}")
+        
+        except Exception as e:
+            logger.error(f"Backup failed for repository {repository.name}: {str(e)}")
+            # Mutate in memory only; the single commit in finally persists
+            # the failed status alongside everything else
+            backup_job.status = 'failed'
+            backup_job.error_message = str(e)
+            backup_job.completed_at = datetime.utcnow()
+
+        finally:
+            # Always clean up temporary directory
+            if temp_clone_dir and temp_clone_dir.exists():
+                try:
+                    logger.info(f"Cleaning up temporary directory: {temp_clone_dir}")
+                    shutil.rmtree(temp_clone_dir)
+                except Exception as cleanup_error:
+                    logger.error(f"Failed to cleanup temp directory {temp_clone_dir}: {cleanup_error}")
+                    # Try force cleanup
+                    try:
+                        shutil.rmtree(temp_clone_dir, onerror=_handle_remove_readonly)
+                        logger.info(f"Force cleaned temp directory: {temp_clone_dir}")
+                    except Exception as force_error:
+                        logger.error(f"Could not force clean temp directory: {force_error}")
+            
+            # Final commit to ensure all changes are saved
+            try:
+                db.session.commit()
+            except Exception as final_commit_error:
+                logger.error(f"Failed final commit for backup job: {final_commit_error}")
+                # Try to rollback to prevent session issues
+                try:
+                    db.session.rollback()
+                except:
+                    pass
+    
+    def _scratch_dir(self, repo_backup_dir, repo_name):
+        """Parent directory for temporary clones.
+
+        Prefers a RAM-backed tmpfs (/dev/shm) so clone bytes never touch the
+        backup disk - otherwise every backup writes the checkout once and the
+        archive again. Falls back to the repo's backup directory when no
+        tmpfs exists; BACKUP_TMP_DIR overrides both.
+        """
+        override = os.environ.get('BACKUP_TMP_DIR')
+        if override:
+            base = Path(override)
+        elif os.path.isdir('/dev/shm'):
+            base = Path('/dev/shm')
+        else:
+            return repo_backup_dir
+        scratch = base / 'ghbackup_tmp' / repo_name
+        try:
+            scratch.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            return repo_backup_dir
+        return scratch
+
+    def _authenticated_url(self, repository):
+        """Return the clone URL, with the token embedded for private repos"""
+        clone_url = repository.url
+        if repository.github_token and repository.github_token.strip():
+            if clone_url.startswith('https://github.com/'):
+                # Convert https://github.com/user/repo to https://token@github.com/user/repo
+                clone_url = clone_url.replace('https://github.com/', f'https://{repository.github_token}@github.com/')
+        return clone_url
+
+    def _update_mirror(self, repository):
+        """Bring the repository's persistent bare mirror up to date.
+
+        The first run clones with --mirror; every run after that fetches,
+        transferring only refs/objects that changed since the last backup
+        instead of re-downloading the whole repository each schedule tick.
+        A failed fetch discards the mirror (it is only a cache of the
+        remote) so the next attempt rebuilds it from scratch.
+        """
+        mirror_dir = self.backup_base_dir / 'mirrors'
+        mirror_dir.mkdir(exist_ok=True)
+        mirror_path = mirror_dir / f"{repository.id}.git"
+        clone_url = self._authenticated_url(repository)
+
+        if (mirror_path / 'HEAD').exists():
+            result = subprocess.run(
+                ['git', '--git-dir', str(mirror_path), 'fetch', '--prune',
+                 clone_url, '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*'],
+                capture_output=True, text=True, timeout=600
+            )
+            if result.returncode == 0:
+                self._repair_mirror_head(mirror_path, clone_url)
+                return mirror_path
+            logger.warning(f"Mirror fetch failed for {repository.name}, recloning: {result.stderr}")
+            shutil.rmtree(mirror_path, ignore_errors=True)
+        elif mirror_path.exists():
+            # Half-created mirror from an interrupted first clone
+            shutil.rmtree(mirror_path, ignore_errors=True)
+
+        result = subprocess.run(
+            ['git', 'clone', '--mirror', clone_url, str(mirror_path)],
+            capture_output=True, text=True, timeout=600
+        )
+        if result.returncode != 0:
+            raise Exception(f"Git mirror clone failed: {result.stderr}")
+        # Don't leave the access token sitting in the mirror's config;
+        # fetches above pass the authenticated URL explicitly
+        subprocess.run(
+            ['git', '--git-dir', str(mirror_path), 'remote', 'set-url',
+             'origin', repository.url],
+            capture_output=True, text=True, timeout=30
+        )
+        logger.info(f"Created mirror for {repository.name} at {mirror_path}")
+        return mirror_path
+
+    def discard_mirror(self, repo_id):
+        """Drop a deleted repository's persistent mirror.
+
+        Mirrors are keyed by repository id and SQLite reuses rowids, so a
+        repository added later could inherit the stale mirror of an
+        unrelated deleted one - and deleted repositories would otherwise
+        leak their full pack data on disk forever.
+        """
+        mirror_path = self.backup_base_dir / 'mirrors' / f"{repo_id}.git"
+        if mirror_path.exists():
+            shutil.rmtree(mirror_path, ignore_errors=True)
+            logger.info(f"Removed mirror for deleted repository {repo_id}")
+
+    def _repair_mirror_head(self, mirror_path, clone_url):
+        """Re-point the mirror's HEAD if it no longer resolves.
+
+        fetch --prune updates branch refs but never HEAD, so a remote
+        default-branch rename leaves HEAD dangling and every
+        'git archive ... HEAD' fails until the mirror is rebuilt. Ask the
+        remote for its current default branch; if that fails (offline,
+        detached HEAD), fall back to any branch the mirror still has.
+        """
+        check = subprocess.run(
+            ['git', '--git-dir', str(mirror_path), 'rev-parse',
+             '--quiet', '--verify', 'HEAD'],
+            capture_output=True, text=True, timeout=30
+        )
+        if check.returncode == 0:
+            return
+
+        target = None
+        remote_head = subprocess.run(
+            ['git', 'ls-remote', '--symref', clone_url, 'HEAD'],
+            capture_output=True, text=True, timeout=60
+        )
+        if remote_head.returncode == 0:
+            for line in remote_head.stdout.splitlines():
+                # 'ref: refs/heads/main\tHEAD'
+                if line.startswith('ref:'):
+                    target = line.split()[1]
+                    break
+        if target is None:
+            local_head = subprocess.run(
+                ['git', '--git-dir', str(mirror_path), 'for-each-ref',
+                 '--format=%(refname)', '--count=1', 'refs/heads'],
+                capture_output=True, text=True, timeout=30
+            )
+            target = local_head.stdout.strip() or None
+        if target:
+            subprocess.run(
+                ['git', '--git-dir', str(mirror_path), 'symbolic-ref', 'HEAD', target],
+                capture_output=True, text=True, timeout=30
+            )
+            logger.warning(f"Mirror HEAD was dangling, re-pointed to {target}")
+
+    def _clone_repository(self, repository, clone_dir, source=None):
+        """Clone a repository to the specified directory.
+
+        With source set (the local mirror path), the checkout comes from
+        disk instead of the network.
+        """
+        clone_url = source or self._authenticated_url(repository)
+
+        # Clean up any existing temp directories for this repository first
+        self._sweep_orphans_once(clone_dir.parent)
+        
+        # Ensure the clone directory is completely clean before starting
+        if clone_dir.exists():
+            logger.warning(f"Clone directory exists before cloning, removing: {clone_dir}")
+            try:
+                shutil.rmtree(clone_dir)
+            except Exception as e:
+                logger.error(f"Failed to remove existing clone directory: {e}")
+                raise Exception(f"Cannot clean clone directory: {e}")
+        
+        # Recreate the directory to ensure it's empty
+        clone_dir.mkdir(parents=True, exist_ok=False)
+        
+        # Clone the repository with error handling
+        try:
+            # Use git command directly for better error handling. The
+            # checkout only needs HEAD of the default branch: skip tags and
+            # other branches, and drop --verbose so subprocess.run doesn't
+            # buffer per-object progress chatter in memory
+            git_cmd = [
+                'git', 'clone',
+                '--depth=1',
+                '--single-branch',
+                '--no-tags',
+                '--config', 'core.autocrlf=false',  # Prevent line ending issues
+                '--config', 'core.filemode=false',  # Prevent permission issues
+            ]
+            git_cmd += [clone_url, str(clone_dir)]
+
+            result = subprocess.run(
+                git_cmd,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+                timeout=300,  # 5 minute timeout
+                cwd=str(clone_dir.parent)
+            )
+
+            if result.returncode != 0:
+                error_msg = f"Git clone failed with exit code {result.returncode}\n"
+                error_msg += f"stderr: {result.stderr}"
+                logger.error(error_msg)
+                raise Exception(f"Git clone failed: {result.stderr}")
+            
+            logger.info(f"Repository cloned successfully to: {clone_dir}")
+            
+        except subprocess.TimeoutExpired:
+            logger.error(f"Git clone timed out for repository: {repository.url}")
+            raise Exception("Git clone operation timed out")
+        except Exception as e:
+            logger.error(f"Git clone failed for {repository.url}: {str(e)}")
+            # Clean up on failure
+            if clone_dir.exists():
+                try:
+                    shutil.rmtree(clone_dir)
+                except:
+                    pass
+            raise e
+    
+    # Directories already swept for crash orphans in this process. Live
+    # temp dirs are reliably removed in backup_repository's finally block,
+    # so the directory scan only needs to run once per location, not on
+    # every backup of a repo with a long history
+    _swept_dirs = set()
+
+    def _sweep_orphans_once(self, parent_dir):
+        key = str(parent_dir)
+        if key in self._swept_dirs:
+            return
+        self._swept_dirs.add(key)
+        self._cleanup_temp_directories(parent_dir)
+
+    def _cleanup_temp_directories(self, repo_backup_dir):
+        """Clean up old temporary directories that might be left behind"""
+        try:
+            if not repo_backup_dir.exists():
+                return
+                
+            temp_dirs = [d for d in repo_backup_dir.iterdir() if d.is_dir() and d.name.startswith('temp_')]
+            current_time = datetime.utcnow().timestamp()
+            
+            for temp_dir in temp_dirs:
+                try:
+                    # Remove temp directories older than 10 minutes or any that exist from failed jobs
+                    dir_age = current_time - temp_dir.stat().st_mtime
+                    if dir_age > 600:  # 10 minutes
+                        logger.info(f"Cleaning up old temp directory: {temp_dir}")
+                        shutil.rmtree(temp_dir)
+                    elif not any(temp_dir.iterdir()):  # Empty directory
+                        logger.info(f"Cleaning up empty temp directory: {temp_dir}")
+                        shutil.rmtree(temp_dir)
+                except (OSError, PermissionError) as e:
+                    logger.warning(f"Failed to remove temp directory {temp_dir}: {e}")
+                    # Try to force remove if it's a permission issue
+                    try:
+                        shutil.rmtree(temp_dir, onerror=_handle_remove_readonly)
+                        logger.info(f"Force removed temp directory: {temp_dir}")
+                    except Exception as force_error:
+                        logger.error(f"Could not force remove temp directory {temp_dir}: {force_error}")
+                        
+        except Exception as e:
+            logger.warning(f"Failed to cleanup temp directories: {e}")
+    
+    def _create_backup(self, source_dir, backup_dir, backup_name, backup_format):
+        """Create backup in the specified format"""
+        if backup_format == 'folder':
+            # Copy the folder structure; when the checkout sits on the same
+            # filesystem as the backup dir the "copy" is metadata-only
+            backup_path = backup_dir / backup_name
+            try:
+                same_fs = os.stat(source_dir).st_dev == os.stat(backup_dir).st_dev
+            except OSError:
+                same_fs = False
+            shutil.copytree(
+                source_dir, backup_path,
+                ignore=shutil.ignore_patterns('.git'),
+                copy_function=_link_or_copy if same_fs else shutil.copy2
+            )
+            return backup_path
+            
+        elif backup_format == 'zip':
+            backup_path = backup_dir / f"{backup_name}.zip"
+            if (source_dir / 'HEAD').exists():
+                return self._archive_from_bare(source_dir, backup_path, 'zip')
+            base_len = len(str(source_dir)) + 1
+            with zipfile.ZipFile(backup_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=_COMPRESSION_LEVEL) as zipf:
+                for file_path in self._walk_files(str(source_dir)):
+                    _, _, ext = file_path.rpartition('.')
+                    # Feed DEFLATE in 1MB slabs instead of zipf.write's 8KB
+                    # reads; strict_timestamps=False skips the pre-1980
+                    # clamp check per file
+                    info = zipfile.ZipInfo.from_file(
+                        file_path, file_path[base_len:], strict_timestamps=False)
+                    info.compress_type = (zipfile.ZIP_STORED
+                                          if '.' + ext.lower() in _INCOMPRESSIBLE
+                                          else zipfile.ZIP_DEFLATED)
+                    with open(file_path, 'rb') as src, zipf.open(info, 'w') as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+            return backup_path
+
+        elif backup_format == 'tar.gz':
+            backup_path = backup_dir / f"{backup_name}.tar.gz"
+            if (source_dir / 'HEAD').exists():
+                return self._archive_from_bare(source_dir, backup_path, 'tar.gz')
+            base_len = len(str(source_dir)) + 1
+            with self._open_tar_gz(backup_path) as tarf:
+                for file_path in self._walk_files(str(source_dir)):
+                    tarf.add(file_path, file_path[base_len:])
+            return backup_path
+
+        elif backup_format == 'tar.zst':
+            backup_path = backup_dir / f"{backup_name}.tar.zst"
+            if (source_dir / 'HEAD').exists():
+                return self._archive_from_bare(source_dir, backup_path, 'tar.zst')
+            base_len = len(str(source_dir)) + 1
+            cctx = zstandard.ZstdCompressor(level=_ZSTD_LEVEL, threads=-1)
+            with open(backup_path, 'wb') as raw, cctx.stream_writer(raw) as zs:
+                with tarfile.open(fileobj=zs, mode='w|', bufsize=1024 * 1024) as tarf:
+                    for file_path in self._walk_files(str(source_dir)):
+                        tarf.add(file_path, file_path[base_len:])
+            return backup_path
+
+        else:
+            raise ValueError(f"Unsupported backup format: {backup_format}")
+    
+    @staticmethod
+    def _walk_files(base_str):
+        """Yield every file path under base_str, skipping .git.
+
+        scandir-based so each entry's type comes from the directory read
+        itself - no per-file Path objects or extra stat() calls, which adds
+        up on repos with tens of thousands of files.
+        """
+        stack = [base_str]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name != '.git':
+                            stack.append(entry.path)
+                    else:
+                        yield entry.path
+
+    def _archive_from_bare(self, git_dir, backup_path, archive_format):
+        """Stream an archive straight from a bare clone's pack data.
+
+        git archive walks the object store in C and writes the archive in one
+        pass - no working-tree checkout, no Python-level os.walk, and .git
+        internals are excluded by construction.
+        """
+        if archive_format == 'tar.zst':
+            # git has no zstd writer; stream its tar output through
+            # zstd-mt, which compresses on all cores at gzip-beating ratios
+            cctx = zstandard.ZstdCompressor(level=_ZSTD_LEVEL, threads=-1)
+            git_proc = subprocess.Popen(
+                ['git', '--git-dir', str(git_dir), 'archive',
+                 '--format=tar', 'HEAD'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            # copy_stream blocks until git's stdout reaches EOF and has no
+            # timeout of its own; kill a wedged git after the same 600s the
+            # other invocations allow, so a hung archive can't pin its
+            # executor slot (and, with max_instances=1, this repo's backups)
+            watchdog = threading.Timer(600, git_proc.kill)
+            watchdog.start()
+            try:
+                with open(backup_path, 'wb') as out:
+                    cctx.copy_stream(git_proc.stdout, out)
+            finally:
+                watchdog.cancel()
+                git_proc.stdout.close()
+                _, git_err = git_proc.communicate(timeout=600)
+            if git_proc.returncode != 0:
+                raise Exception(f"git archive failed: {git_err.decode(errors='replace')}")
+            return backup_path
+
+        if archive_format == 'tar.gz' and _PIGZ:
+            # Pipe an uncompressed tar stream through pigz so gzip runs on
+            # all cores instead of git's single-threaded zlib
+            with open(backup_path, 'wb') as out:
+                git_proc = subprocess.Popen(
+                    ['git', '--git-dir', str(git_dir), 'archive',
+                     '--format=tar', 'HEAD'],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                )
+                pigz_proc = subprocess.Popen(
+                    [_PIGZ, f'-{_COMPRESSION_LEVEL}', '-p', str(os.cpu_count() or 1)],
+                    stdin=git_proc.stdout, stdout=out, stderr=subprocess.PIPE
+                )
+                git_proc.stdout.close()  # let pigz receive git's SIGPIPE
+                _, git_err = git_proc.communicate(timeout=600)
+                _, pigz_err = pigz_proc.communicate(timeout=600)
+            if git_proc.returncode != 0:
+                raise Exception(f"git archive failed: {git_err.decode(errors='replace')}")
+            if pigz_proc.returncode != 0:
+                raise Exception(f"pigz failed: {pigz_err.decode(errors='replace')}")
+            return backup_path
+
+        result = subprocess.run(
+            ['git', '--git-dir', str(git_dir), 'archive',
+             f'--format={archive_format}', f'-{_COMPRESSION_LEVEL}',
+             '-o', str(backup_path), 'HEAD'],
+            capture_output=True, text=True, timeout=600
+        )
+        if result.returncode != 0:
+            raise Exception(f"git archive failed: {result.stderr}")
+        return backup_path
+
+    @contextmanager
+    def _open_tar_gz(self, backup_path):
+        """Open a .tar.gz for writing, compressing with pigz when available.
+
+        Falls back to tarfile's built-in (single-threaded) gzip when pigz
+        isn't on PATH, so behaviour is unchanged on minimal images.
+        """
+        if not _PIGZ:
+            with tarfile.open(backup_path, 'w:gz', compresslevel=_COMPRESSION_LEVEL,
+                              bufsize=1024 * 1024) as tarf:
+                yield tarf
+            return
+        with open(backup_path, 'wb') as out:
+            proc = subprocess.Popen(
+                [_PIGZ, f'-{_COMPRESSION_LEVEL}', '-p', str(os.cpu_count() or 1)],
+                stdin=subprocess.PIPE, stdout=out
+            )
+            try:
+                with tarfile.open(fileobj=proc.stdin, mode='w|',
+                                  bufsize=1024 * 1024) as tarf:
+                    yield tarf
+            finally:
+                proc.stdin.close()
+                proc.wait(timeout=600)
+        if proc.returncode != 0:
+            raise Exception(f"pigz exited with code {proc.returncode}")
+
+    @staticmethod
+    def _fast_digest(path):
+        """Content digest for change detection (blake2b, streamed in 1MB chunks)"""
+        h = hashlib.blake2b()
+        with open(path, 'rb', buffering=0) as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+        return h.digest()
+
+    def _dedup_against_previous(self, repo_backup_dir, new_backup):
+        """Hard-link files that are unchanged since the previous folder backup.
+
+        rsnapshot-style: with N retained folder backups of a slow-changing
+        repo, disk usage collapses from N full copies toward one copy plus
+        the deltas. git checkouts reset mtimes, so candidates are matched by
+        relative path + size and confirmed by content digest before linking.
+        Retention cleanup is unaffected - deleting a backup just drops link
+        counts.
+        """
+        try:
+            previous = [d for d in repo_backup_dir.iterdir()
+                        if d.is_dir() and not d.name.startswith('temp_') and d != new_backup]
+            if not previous:
+                return
+            prev = max(previous, key=lambda d: d.stat().st_mtime)
+            base_len = len(str(new_backup)) + 1
+            linked = 0
+            for file_path in self._walk_files(str(new_backup)):
+                prev_path = os.path.join(str(prev), file_path[base_len:])
+                try:
+                    if os.path.getsize(prev_path) != os.path.getsize(file_path):
+                        continue
+                    if self._fast_digest(prev_path) != self._fast_digest(file_path):
+                        continue
+                    tmp_link = file_path + '.dedup'
+                    os.link(prev_path, tmp_link)
+                    os.replace(tmp_link, file_path)
+                    linked += 1
+                except OSError:
+                    continue
+            if linked:
+                logger.info(f"Hard-linked {linked} unchanged files against previous backup {prev.name}")
+        except Exception as e:
+            logger.warning(f"Backup dedup pass skipped: {e}")
+
+    _ARCHIVE_SUFFIXES = {'zip': '.zip', 'tar.gz': '.tar.gz', 'tar.zst': '.tar.zst'}
+
+    def _cleanup_old_backups(self, backup_dir, retention_count, backup_format):
+        """Remove old backups beyond retention count.
+
+        One scandir pass collects (mtime, path, is_dir) per candidate, so
+        the DirEntry's cached stat serves both the sort and the remove
+        instead of re-statting each path.
+        """
+        if backup_format != 'folder':
+            suffix = self._ARCHIVE_SUFFIXES.get(backup_format)
+            if suffix is None:
+                return
+
+        backups = []
+        with os.scandir(backup_dir) as it:
+            for entry in it:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if backup_format == 'folder':
+                    if not is_dir or entry.name.startswith('temp_'):
+                        continue
+                elif is_dir or not entry.name.endswith(suffix):
+                    continue
+                backups.append((entry.stat(follow_symlinks=False).st_mtime, entry.path, is_dir))
+
+        # Sort by modification time (newest first)
+        backups.sort(reverse=True)
+
+        # Remove backups beyond retention count
+        for _, backup_to_remove, is_dir in backups[retention_count:]:
+            try:
+                if is_dir:
+                    shutil.rmtree(backup_to_remove)
+                else:
+                    os.unlink(backup_to_remove)
+                logger.info(f"Removed old backup: {backup_to_remove}")
+            except Exception as e:
+                logger.error(f"Failed to remove old backup {backup_to_remove}: {str(e)}")
+    
+    def _get_file_size(self, path):
+        """Get file or directory size in bytes.
+
+        Directory sizes come from a scandir walk: one stat per entry (cached
+        on the DirEntry) instead of rglob's separate is_file()/stat() pair.
+        """
+        path = str(path)
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        if not os.path.isdir(path):
+            return 0
+        total = 0
+        stack = [path]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        if stat.S_ISREG(st.st_mode):
+                            total += st.st_size
+                        elif stat.S_ISDIR(st.st_mode):
+                            stack.append(entry.path)
+            except OSError:
+                continue
+        return total
+    
+    def verify_github_access(self, repo_url, github_token=None):
+        """Verify if we can access a GitHub repository"""
+        try:
+            # Parse the URL and check the hostname
+            parsed = urlparse(repo_url)
+            if parsed.hostname and parsed.hostname.lower() == "github.com":
+                # Path is of the form /owner/repo(.git)? or /owner/repo/
+                path_parts = parsed.path.strip("/").split("/")
+                if len(path_parts) >= 2:
+                    owner = path_parts[0]
+                    repo_name = path_parts[1]
+                    if repo_name.endswith('.git'):
+                        repo_name = repo_name[:-4]
+
+                    # A HEAD against the repos endpoint answers yes/no
+                    # without transferring or parsing the full metadata
+                    # JSON that PyGithub's get_repo pulls down
+                    headers = {'Authorization': f'token {github_token}'} if github_token else {}
+                    resp = _http.head(
+                        f'https://api.github.com/repos/{owner}/{repo_name}',
+                        headers=headers, timeout=5, allow_redirects=True
+                    )
+                    if resp.status_code == 200:
+                        return True, f"Repository access verified: {owner}/{repo_name}"
+                    if resp.status_code == 404:
+                        return False, f"Repository not found (or token lacks access): {owner}/{repo_name}"
+                    return False, f"Repository access failed: HTTP {resp.status_code}"
+
+            return False, "Invalid GitHub repository URL"
+
+        except Exception as e:
+            return False, f"Repository access failed: {str(e)}"
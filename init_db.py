@@ -1,43 +1,125 @@
-import os
-from app import app
-from models import db
-
-def ensure_sqlite_path():
-    uri = app.config.get('SQLALCHEMY_DATABASE_URI')
-    if uri and uri.startswith('sqlite:///'):
-        db_file = uri.replace('sqlite:///', '')
-        db_dir = os.path.dirname(db_file)
-        if db_dir and not os.path.isdir(db_dir):
-            os.makedirs(db_dir, exist_ok=True)
-            print(f"Created database directory: {db_dir}")
-        print(f"Target SQLite file: {db_file}")
-        return db_file
-    return None
-
-if __name__ == '__main__':
-    db_file = ensure_sqlite_path()
-    with app.app_context():
-        try:
-            # Create tables if they don't exist
-            db.create_all()
-            
-            # Update existing users without theme to use dark theme
-            from models import User
-            users_without_theme = User.query.filter_by(theme=None).all()
-            for user in users_without_theme:
-                user.theme = 'dark'
-            
-            if users_without_theme:
-                db.session.commit()
-                print(f"Updated {len(users_without_theme)} users to use dark theme by default")
-            
-            print("Database initialized successfully!")
-            
-            if db_file and os.path.exists(db_file):
-                st = os.stat(db_file)
-                print(f"Database file created: {db_file} (size {st.st_size} bytes, perms {oct(st.st_mode)[-3:]})")
-            elif db_file:
-                print(f"Warning: Database file not found yet at {db_file}")
-        except Exception as e:
-            print(f"Error creating database: {e}")
-            raise
+import hashlib
+import os
+import sqlite3
+
+from sqlalchemy import create_engine, inspect, text
+
+# Only the model metadata is needed here; importing app would pull in Flask,
+# the scheduler and the backup service - seconds of import time just to run
+# DDL during container boot
+from models import db
+
+# Keep the default in sync with app.py
+DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:////app/data/github_backup.db')
+
+def ensure_sqlite_path():
+    if DATABASE_URI.startswith('sqlite:///'):
+        db_file = DATABASE_URI.replace('sqlite:///', '')
+        db_dir = os.path.dirname(db_file)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+            print(f"Created database directory: {db_dir}")
+        print(f"Target SQLite file: {db_file}")
+        return db_file
+    return None
+
+def schema_fingerprint():
+    """Digest of the model metadata: tables, columns and index names"""
+    parts = []
+    for table in db.metadata.sorted_tables:
+        cols = ','.join(f'{c.name}:{c.type}' for c in table.columns)
+        indexes = ','.join(sorted(ix.name for ix in table.indexes))
+        parts.append(f'{table.name}({cols})[{indexes}]')
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+def stored_fingerprint(db_file):
+    """Fingerprint recorded by the last successful init, or None"""
+    try:
+        with sqlite3.connect(db_file) as conn:
+            row = conn.execute('SELECT fingerprint FROM _schema_version').fetchone()
+            return row[0] if row else None
+    except sqlite3.Error:
+        # Missing table/fresh file: fall through to a full init
+        return None
+
+def store_fingerprint(db_file, fingerprint):
+    with sqlite3.connect(db_file) as conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS _schema_version (fingerprint TEXT NOT NULL)')
+        conn.execute('DELETE FROM _schema_version')
+        conn.execute('INSERT INTO _schema_version (fingerprint) VALUES (?)', (fingerprint,))
+
+if __name__ == '__main__':
+    db_file = ensure_sqlite_path()
+
+    # Skip the whole create_all + index-backfill pass when the schema hasn't
+    # changed since the last successful init; CREATE TABLE IF NOT EXISTS per
+    # table plus reflection holds the write lock during boot for nothing
+    fingerprint = schema_fingerprint()
+    if db_file and os.path.exists(db_file) and stored_fingerprint(db_file) == fingerprint:
+        print("Database schema is current, skipping initialization")
+        raise SystemExit(0)
+
+    engine = create_engine(DATABASE_URI)
+    try:
+        # Create tables if they don't exist
+        db.metadata.create_all(engine)
+
+        # create_all skips tables that already exist, so indexes added to
+        # the models later need to be backfilled explicitly
+        inspector = inspect(engine)
+        created_indexes = 0
+        for table in db.metadata.tables.values():
+            existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    try:
+                        index.create(engine)
+                        created_indexes += 1
+                    except Exception as index_error:
+                        message = str(index_error)
+                        # Expression indexes aren't reported by SQLite
+                        # reflection, so "already exists" is expected here
+                        if 'already exists' in message:
+                            continue
+                        # Existing rows can legally violate a unique index
+                        # added after the fact (e.g. case-variant usernames
+                        # predating ix_user_username_lower); skipping the
+                        # index must not crash-loop the container on boot
+                        if 'UNIQUE constraint failed' in message:
+                            print(f"Skipped unique index {index.name}: "
+                                  f"existing rows conflict ({message.splitlines()[0]})")
+                            if index.name == 'ix_user_username_lower':
+                                with engine.connect() as conn:
+                                    dupes = conn.execute(text(
+                                        'SELECT group_concat(username, ", ") FROM "user" '
+                                        'GROUP BY lower(username) HAVING count(*) > 1'
+                                    )).fetchall()
+                                for (names,) in dupes:
+                                    print(f"  Conflicting usernames: {names}")
+                            continue
+                        raise
+        if created_indexes:
+            print(f"Created {created_indexes} missing indexes on existing tables")
+
+        # Update existing users without theme to use dark theme
+        with engine.begin() as conn:
+            updated = conn.execute(
+                text('UPDATE "user" SET theme = :theme WHERE theme IS NULL'),
+                {'theme': 'dark'},
+            ).rowcount
+        if updated:
+            print(f"Updated {updated} users to use dark theme by default")
+
+        print("Database initialized successfully!")
+
+        if db_file and os.path.exists(db_file):
+            store_fingerprint(db_file, fingerprint)
+            st = os.stat(db_file)
+            print(f"Database file created: {db_file} (size {st.st_size} bytes, perms {oct(st.st_mode)[-3:]})")
+        elif db_file:
+            print(f"Warning: Database file not found yet at {db_file}")
+    except Exception as e:
+        print(f"Error creating database: {e}")
+        raise
+    finally:
+        engine.dispose()